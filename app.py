@@ -1,47 +1,241 @@
-from flask import Flask, render_template, request, redirect, url_for, session, make_response
-import csv, os
+from flask import Flask, render_template, stream_template, request, redirect, url_for, session, make_response, Response, jsonify
+from flask import g, has_request_context
+from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
+import csv, os, sys
+import tempfile
 from datetime import datetime, timedelta
 import random, string
 import qrcode
 import hashlib, hmac, base64, time
+import json
 import math
+import heapq
+import io, threading, queue
+import gzip
+import mmap, struct
+from array import array
+from collections import Counter
+from functools import lru_cache
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import openpyxl  # optional, only needed for XLSX export
+except ImportError:
+    openpyxl = None
+
+try:
+    import numpy as np  # optional, vectorises batch geofence checks and columnar partition filters
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey"  # required for sessions
 
 SECRET_KEY = b"super_secret_unlock_key"
 STUDENT_FILE = "students.csv"
-ATTEND_FILE = "attendance.csv"
+ATTEND_FILE = "attendance.csv"  # legacy single-file log, migrated into ATTEND_DIR
+ATTEND_DIR = "attendance"  # one CSV partition per day: attendance/YYYY-MM-DD.csv
+ARCHIVE_DIR = "archive"  # compressed per-month segments: archive/<name>-YYYY-MM.csv.gz
+ATTEND_RETAIN_DAYS = 60  # days of attendance kept as plain partitions before they are archived
+COMPACT_BYTES = 1024 * 1024  # compact tokens.csv / class_codes.csv once they outgrow this
+ATTEND_COLUMNS = True  # keep a memory-mapped columnar copy (.bin) of each closed day's partition
+COLUMNS_MAPPED = 64  # partitions kept mapped per process (each holds a file descriptor)
 CODE_FILE = "class_codes.csv"
 TOKEN_FILE = "tokens.csv"
 TEACHER_FILE = "teachers.csv"
 LOCK_FILE = "lock.csv"
+TOKEN_FIELDS = ["token","class","year","subject","date","used","student_id"]
+ATTEND_FIELDS = ["id","name","class","year","subject","time","code"]
+CODE_FIELDS = ["date","class","year","subject","code","lat","lng"]
+LOCK_FIELDS = ["student_id","unlock_time"]
+PAGE_SIZE = 100  # attendance rows per /teacher page
+GEOFENCE_RADIUS = 100  # meters a student may be from the teacher's location
+LOCK_MINUTES = 40  # server-side lock after a successful mark (matches the lock_until cookie)
+LOCK_COMPACT_SECONDS = 600  # at most one rewrite of LOCK_FILE per this many seconds
+MARK_BATCH_LIMIT = 500  # submissions accepted by one /mark/batch request
+GROUP_COMMIT = True  # funnel attendance commits through one background writer
+GROUP_COMMIT_MS = 5  # how long the writer waits for more rows before flushing
+GROUP_COMMIT_ROWS = 200  # flush early once this many rows are waiting
+GROUP_COMMIT_TIMEOUT = 30  # seconds a request waits for the writer to take its rows before failing
+QR_DIR = "static/qrcodes"
+QR_CACHE_SIZE = 256  # QR PNGs kept in memory
+ROTATE_CODES = False  # derive class codes from the clock instead of the daily code in CODE_FILE
+ROTATE_SECONDS = 30  # lifetime of one rotating QR frame
+ROTATE_MARK_GRACE = 10  # frames a scanned code stays valid for /mark (time to fill in the form)
+ROTATING_CODE_LABEL = "ROTATING"  # attendance code recorded when no daily code exists
+SIGNED_TOKENS = False  # issue HMAC-signed scan tokens instead of storing each one in TOKEN_FILE
+SIGNED_TOKEN_TTL = 600  # seconds a signed scan token stays valid
+PASSWORD_ITERATIONS = 200000  # PBKDF2-SHA256 rounds for new hashes (each hash records its own count)
+LOGIN_ATTEMPTS_PER_MINUTE = 10  # sustained failed /login attempts allowed per username
+LOGIN_BURST = 10  # failed attempts allowed back to back before the per-minute rate applies
+# Per client IP the limits are higher: behind a campus NAT every teacher shares one address.
+# Behind a reverse proxy, set TRUSTED_PROXIES so the address is the client's, not the proxy's.
+LOGIN_IP_ATTEMPTS_PER_MINUTE = 60
+LOGIN_IP_BURST = 100
+TRUSTED_PROXIES = 0  # reverse proxies in front of the app whose X-Forwarded-For/-Proto are trusted
+LOGIN_BUCKETS_MAX = 10000  # rate-limit buckets kept before idle ones are dropped
+# An open live stream occupies a request thread. Streams are only held open when the server
+# runs requests in threads (asgi.py, the threaded dev server, gunicorn gthread); under
+# one-thread-per-worker servers (gunicorn sync) every viewer polls every LIVE_RETRY_MS instead.
+LIVE_STREAM_SECONDS = 30  # a live view's event stream is closed after this; the browser reconnects
+LIVE_MAX_STREAMS = 16  # open live streams per process; further viewers poll instead
+LIVE_RETRY_MS = 3000  # reconnect delay sent to the browser
+LIVE_POLL_SECONDS = 1  # how often a stream checks the partition for marks made by other workers
+SLOW_REQUEST_MS = 500  # log requests slower than this with a per-stage breakdown (0 disables)
+
+if TRUSTED_PROXIES:
+    # take the client address and scheme from the proxies' X-Forwarded-* headers
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+# guards the in-memory indexes below (the dev server is threaded)
+_index_lock = threading.RLock()
+
+# --------- Metrics ----------
+# counters and latency histograms, exported in Prometheus text format on /metrics
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_counters = {}
+_histograms = {}
+_metrics_lock = threading.Lock()
+
+def count(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        hist = _histograms.setdefault(key, {"buckets": [0] * len(_BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(_BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+@contextmanager
+def timed(stage):
+    """Time one stage of the work (CSV load, append, commit, QR encode...).
+
+    Recorded in the stage histogram and, inside a request, in the per-request
+    breakdown used by the slow request log.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("attendance_stage_seconds", elapsed, stage=stage)
+        if has_request_context() and "stages" in g:
+            g.stages.append((stage, elapsed))
+
+def _file_label(path):
+    # partitions are reported as their directory so labels stay bounded
+    return os.path.dirname(path) or path
 
 # --------- Helpers ----------
-def load_students():
+_file_cache = {}
+
+def _cached(path, build, *args):
+    """Return build(*args) for the current version of `path`.
+
+    The result is kept per process and rebuilt only when the file's
+    mtime, size or inode changes. Cached values are shared: treat them as read-only.
+    """
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        stamp = None
+    key = (path, build.__name__)
+    with _index_lock:
+        hit = _file_cache.get(key)
+        if hit is not None and hit[0] == stamp:
+            return hit[1]
+    with timed("load:" + _file_label(path)):
+        value = build(*args)
+    with _index_lock:
+        _file_cache[key] = (stamp, value)
+    return value
+
+def _read_roster():
     students = {}
     if os.path.exists(STUDENT_FILE):
         with open(STUDENT_FILE, newline='', encoding="utf-8") as f:
             reader = csv.DictReader(f)
             for row in reader:
                 students[row["id"]] = {"name": row["name"], "class": row["class"]}
-    return students
+    count("attendance_rows_scanned_total", len(students), file=STUDENT_FILE)
+    by_class = {}
+    for sid, student in students.items():
+        by_class.setdefault(student["class"], []).append(sid)
+    return {"students": students, "classes": sorted(by_class), "by_class": by_class}
+
+def _read_codes():
+    # past days' codes live in the archive after compaction
+    rows = list(_cached(ARCHIVE_DIR, _read_archived_codes))
+    sessions = {}
+    if os.path.exists(CODE_FILE):
+        with open(CODE_FILE, newline='', encoding="utf-8") as f:
+            hot = list(csv.DictReader(f))
+        count("attendance_rows_scanned_total", len(hot), file=CODE_FILE)
+        rows.extend(hot)
+    dates = {}
+    locations = {}
+    for row in rows:
+        key = (row["class"], row["year"], row["subject"], row["date"])
+        sessions.setdefault(key, row)
+        dates.setdefault(key[:3], set()).add(row["date"])
+        if key not in locations and row.get("lat") and row.get("lng"):
+            try:
+                locations[key] = (float(row["lat"]), float(row["lng"]))
+            except ValueError:
+                locations[key] = (math.nan, math.nan)  # fails the check instead of skipping it
+    return {"rows": rows, "sessions": sessions, "dates": dates, "locations": locations}
+
+def load_students():
+    return _cached(STUDENT_FILE, _read_roster)["students"]
+
+def load_codes():
+    return _cached(CODE_FILE, _read_codes)["rows"]
+
+def get_session(class_name, year, subject, date):
+    """Return the class_codes.csv row for a class session, or None."""
+    return _cached(CODE_FILE, _read_codes)["sessions"].get((class_name, year, subject, date))
+
+def session_location(class_name, year, subject, date):
+    """Teacher's (lat, lng) for a class session, parsed once per version of CODE_FILE, or None."""
+    return _cached(CODE_FILE, _read_codes)["locations"].get((class_name, year, subject, date))
 
 def get_today_code(class_name, year, subject):
     today = datetime.now().strftime("%Y-%m-%d")
-    if not os.path.exists(CODE_FILE):
-        return None
-    with open(CODE_FILE, newline='', encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if (
-                row["date"] == today
-                and row["class"] == class_name
-                and row["year"] == year
-                and row["subject"] == subject
-            ):
-                return row["code"]
-    return None
+    row = get_session(class_name, year, subject, today)
+    return row["code"] if row else None
+
+def rotating_code(class_name, year, subject, window=None, length=6):
+    """Class code for one ROTATE_SECONDS time window, derived with HMAC so no storage is needed."""
+    if window is None:
+        window = int(time.time()) // ROTATE_SECONDS
+    data = f"{class_name}|{year}|{subject}|{window}".encode()
+    digest = hmac.new(SECRET_KEY, data, hashlib.sha256).digest()
+    return base64.b32encode(digest).decode()[:length]
+
+def code_is_valid(class_name, year, subject, code, grace=1):
+    """Check a class code against today's code, or in rotating mode against the
+    current frame and the `grace` frames before it."""
+    if ROTATE_CODES:
+        window = int(time.time()) // ROTATE_SECONDS
+        # compare bytes: compare_digest rejects str with non-ASCII characters
+        return any(hmac.compare_digest(code.encode(), rotating_code(class_name, year, subject, w).encode())
+                   for w in range(window - grace, window + 1))
+    valid_code = get_today_code(class_name, year, subject)
+    return bool(valid_code) and code == valid_code
 
 def generate_code(length=6):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
@@ -49,110 +243,1151 @@ def generate_code(length=6):
 def generate_token(length=8):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
+_thread_locks = {}
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path` across threads and worker processes.
+
+    The OS lock is taken on a `<path>.lock` side file so the data file itself
+    can be replaced with os.replace while the lock is held.
+    """
+    with _index_lock:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+    with thread_lock, open(path + ".lock", "a+") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _append_csv(path, fieldnames, rows, sync=False):
+    """Append rows to a CSV file in a single write, adding the header to a new file.
+
+    Callers that share the file with other writers must hold file_lock(path).
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        writer.writerow(fieldnames)
+    for row in rows:
+        writer.writerow([row.get(k, "") for k in fieldnames])
+    data = buf.getvalue()
+    with timed("append:" + _file_label(path)), open(path, "a", newline='', encoding="utf-8") as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    count("attendance_bytes_written_total", len(data.encode("utf-8")), file=_file_label(path), mode="append")
+
+def _write_csv_atomic(path, fieldnames, rows):
+    """Rewrite a CSV file via a temp file and os.replace, so readers never see half a file."""
+    tmp_path = path + ".tmp"
+    with timed("rewrite:" + _file_label(path)):
+        with open(tmp_path, "w", newline='', encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    count("attendance_bytes_written_total", os.path.getsize(path), file=_file_label(path), mode="rewrite")
+
+def _tail_csv(path, state):
+    """Return (rows, reset) for the rows appended to `path` since the last call.
+
+    `state` keeps the byte offset, inode and header between calls. If the file
+    was replaced or truncated it is read again from the start and `reset` is
+    True so the caller can drop whatever it built from the old file. A partly
+    written last line is left for the next call.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        reset = bool(state.get("offset"))
+        state.clear()
+        return [], reset
+    reset = False
+    if st.st_ino != state.get("ino") or st.st_size < state.get("offset", 0):
+        reset = "ino" in state
+        state.clear()
+        state.update(ino=st.st_ino, offset=0, header=None)
+    if st.st_size == state["offset"]:
+        return [], reset
+    with open(path, "rb") as f:
+        f.seek(state["offset"])
+        chunk = f.read(st.st_size - state["offset"])
+    end = chunk.rfind(b"\n") + 1
+    if not end:
+        return [], reset
+    state["offset"] += end
+    lines = list(csv.reader(chunk[:end].decode("utf-8").splitlines()))
+    if state["header"] is None and lines:
+        state["header"] = lines.pop(0)
+    header = state["header"]
+    rows = [dict(zip(header, line)) for line in lines if line]
+    count("attendance_rows_scanned_total", len(rows), file=_file_label(path))
+    count("attendance_bytes_read_total", end, file=_file_label(path))
+    return rows, reset
+
+# token index: token -> latest row, holding today's tokens only
+_tokens = {}
+_token_state = {}
+_token_day = [None]
+
+def _sync_tokens():
+    """Bring the token index up to date with tokens.csv (appended rows only)."""
+    today = datetime.now().strftime("%Y-%m-%d")
+    with _index_lock:
+        rows, reset = _tail_csv(TOKEN_FILE, _token_state)
+        if reset or _token_day[0] != today:
+            _tokens.clear()
+            _token_day[0] = today
+        for row in rows:
+            # tokens expire with the day they were issued on
+            if row["date"] == today:
+                _tokens[row["token"]] = row
+
 def save_token(token, class_name, year, subject):
     today = datetime.now().strftime("%Y-%m-%d")
-    tokens = []
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, newline='', encoding="utf-8") as f:
-            tokens = list(csv.DictReader(f))
-
-    tokens.append({
-        "token": token,
-        "class": class_name,
-        "year": year,
-        "subject": subject,
-        "date": today,
-        "used": "0",
-        "student_id": ""
-    })
-
-    with open(TOKEN_FILE, "w", newline='', encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=["token","class","year","subject","date","used","student_id"])
-        writer.writeheader()
-        writer.writerows(tokens)
-
-def token_is_valid(token):
-    if not os.path.exists(TOKEN_FILE):
-        return False
-    with open(TOKEN_FILE, newline='', encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row["token"] == token and row["used"] == "0":
-                return True
-    return False
-
-def mark_token_used(token, student_id):
-    if not os.path.exists(TOKEN_FILE):
+    with file_lock(TOKEN_FILE):
+        _append_csv(TOKEN_FILE, TOKEN_FIELDS, [{
+            "token": token,
+            "class": class_name,
+            "year": year,
+            "subject": subject,
+            "date": today,
+            "used": "0",
+            "student_id": ""
+        }])
+    _sync_tokens()
+
+def generate_signed_token(class_name, year, subject):
+    """Scan token bound to the class session and today's date; nothing is stored.
+
+    The random nonce is what gets recorded in TOKEN_FILE once the token is used.
+    """
+    expiry = int(time.time()) + SIGNED_TOKEN_TTL
+    today = datetime.now().strftime("%Y-%m-%d")
+    data = "|".join([class_name, year, subject, today, str(expiry), generate_token()]).encode()
+    signature = hmac.new(SECRET_KEY, data, hashlib.sha256).digest()
+    return (base64.urlsafe_b64encode(data) + b"." + base64.urlsafe_b64encode(signature)).decode()
+
+def verify_signed_token(token, class_name, year, subject):
+    """Return the nonce of a valid signed token for this session, or None."""
+    try:
+        data_part, sig_part = token.encode().split(b".")
+        data = base64.urlsafe_b64decode(data_part)
+        expected_sig = hmac.new(SECRET_KEY, data, hashlib.sha256).digest()
+        if not hmac.compare_digest(base64.urlsafe_b64decode(sig_part), expected_sig):
+            return None
+        t_class, t_year, t_subject, t_date, expiry, nonce = data.decode().split("|")
+        if (t_class, t_year, t_subject) != (class_name, year, subject):
+            return None
+        if t_date != datetime.now().strftime("%Y-%m-%d") or time.time() > int(expiry):
+            return None
+        return nonce
+    except Exception:
+        return None
+
+def issue_token(class_name, year, subject):
+    if SIGNED_TOKENS:
+        return generate_signed_token(class_name, year, subject)
+    token = generate_token()
+    save_token(token, class_name, year, subject)
+    return token
+
+def _token_available(token_key):
+    # signed tokens are usable until their nonce shows up in the index; stored ones until marked used
+    row = _tokens.get(token_key)
+    if SIGNED_TOKENS:
+        return row is None
+    return row is not None and row["used"] == "0"
+
+def check_token(token, class_name, year, subject):
+    """Return the key to consume for a submitted scan token, or None if it cannot be used."""
+    if not token:
+        return None
+    if SIGNED_TOKENS:
+        token = verify_signed_token(token, class_name, year, subject)
+        if token is None:
+            return None
+    _sync_tokens()
+    return token if _token_available(token) else None
+
+def attendance_path(date):
+    return os.path.join(ATTEND_DIR, f"{date}.csv")
+
+def _partition_dates():
+    if not os.path.isdir(ATTEND_DIR):
+        return []
+    return [n[:-4] for n in os.listdir(ATTEND_DIR) if n.endswith(".csv")]
+
+def attendance_dates():
+    """Dates that have an attendance partition, plain or archived, newest first."""
+    return sorted(set(_partition_dates()) | set(_archive_index()["segments"]), reverse=True)
+
+def _read_partition(date):
+    path = attendance_path(date)
+    if not os.path.exists(path):
+        segment = _archive_index()["segments"].get(date)
+        return _read_segment(segment).get(date, []) if segment else []
+    with timed("read:" + ATTEND_DIR), open(path, newline='', encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    count("attendance_rows_scanned_total", len(rows), file=ATTEND_DIR)
+    return rows
+
+def _read_partition_meta(date):
+    """Secondary index for one partition: row count per (class, year, subject)."""
+    with _open_columns(date) as part:
+        if part is not None:
+            return _column_groups(part, ("class", "year", "subject"))
+    sessions = {}
+    for row in _read_partition(date):
+        key = (row["class"], row["year"], row["subject"])
+        sessions[key] = sessions.get(key, 0) + 1
+    return sessions
+
+def partition_meta(date):
+    path = attendance_path(date)
+    if not os.path.exists(path):
+        archived = _archive_index()["meta"].get(date)
+        if archived is not None:
+            return archived
+    return _cached(path, _read_partition_meta, date)
+
+def _migrate_attendance():
+    """Split a legacy attendance.csv into per-day partitions (once)."""
+    if not os.path.exists(ATTEND_FILE):
         return
-    with open(TOKEN_FILE, newline='', encoding="utf-8") as f:
-        tokens = list(csv.DictReader(f))
-    for row in tokens:
-        if row["token"] == token:
-            row["used"] = "1"
-            row["student_id"] = student_id
-    with open(TOKEN_FILE, "w", newline='', encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=["token","class","year","subject","date","used","student_id"])
-        writer.writeheader()
-        writer.writerows(tokens)
+    with file_lock(ATTEND_DIR):
+        if not os.path.exists(ATTEND_FILE):
+            return
+        with open(ATTEND_FILE, newline='', encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        by_date = {}
+        for row in rows:
+            by_date.setdefault(row["time"][:10], []).append(row)
+        os.makedirs(ATTEND_DIR, exist_ok=True)
+        for date, date_rows in by_date.items():
+            # one atomic rewrite per day, merged with what the partition already holds:
+            # a rerun after a crash finds its rows there instead of adding them again
+            path = attendance_path(date)
+            merged = []
+            if os.path.exists(path):
+                with open(path, newline='', encoding="utf-8") as f:
+                    merged = [tuple(r.get(k, "") for k in ATTEND_FIELDS) for r in csv.DictReader(f)]
+            present = Counter(merged)
+            for row in date_rows:
+                key = tuple(row.get(k, "") for k in ATTEND_FIELDS)
+                if present[key]:
+                    present[key] -= 1
+                else:
+                    merged.append(key)
+            _write_csv_atomic(path, ATTEND_FIELDS, [dict(zip(ATTEND_FIELDS, key)) for key in merged])
+        os.replace(ATTEND_FILE, ATTEND_FILE + ".migrated")
+
+# --------- Archive ----------
+# Compaction moves past rows out of the hot files into gzip segments, one per file and
+# month: tokens and codes from before today, and day partitions older than
+# ATTEND_RETAIN_DAYS. Archived attendance also gets a small uncompressed
+# attendance-YYYY-MM.meta.csv (rows per date and session), so listing and paging never
+# decompress a segment that isn't read.
+ARCHIVE_META_FIELDS = ["date", "class", "year", "subject", "rows"]
+_segment_cache = {}
+_compacted = [None]
+
+def archive_path(name, month):
+    return os.path.join(ARCHIVE_DIR, f"{name}-{month}.csv.gz")
+
+def _archive_files(name, suffix=".csv.gz"):
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    return sorted(os.path.join(ARCHIVE_DIR, n) for n in os.listdir(ARCHIVE_DIR)
+                  if n.startswith(name + "-") and n.endswith(suffix))
+
+def _read_gzip_csv(path):
+    if not os.path.exists(path):
+        return []
+    with timed("read:" + ARCHIVE_DIR), gzip.open(path, "rt", newline='', encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    count("attendance_rows_scanned_total", len(rows), file=ARCHIVE_DIR)
+    return rows
+
+def _write_gzip_csv_atomic(path, fieldnames, rows):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=ARCHIVE_DIR, suffix=".tmp")
+    with timed("rewrite:" + ARCHIVE_DIR), os.fdopen(fd, "wb") as raw:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode="wb"), encoding="utf-8", newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    count("attendance_bytes_written_total", os.path.getsize(path), file=ARCHIVE_DIR, mode="rewrite")
+
+def _merge_segment(path, fieldnames, rows, replaced):
+    """Rewrite a segment with `rows` added, dropping existing rows for which replaced(row) is true.
+
+    Rows are merged rather than appended so a compaction that is rerun after
+    a crash does not archive the same rows twice.
+    """
+    merged = [r for r in _read_gzip_csv(path) if not replaced(r)] + rows
+    _write_gzip_csv_atomic(path, fieldnames, merged)
+    return merged
+
+def _read_archived_codes():
+    rows = []
+    for path in _archive_files("class_codes"):
+        rows.extend(_read_gzip_csv(path))
+    return rows
+
+def _read_archive_index():
+    """Archived attendance dates: segment path and partition metadata per date."""
+    segments, meta = {}, {}
+    for path in _archive_files("attendance", ".meta.csv"):
+        segment = path[:-len(".meta.csv")] + ".csv.gz"
+        with open(path, newline='', encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                segments[row["date"]] = segment
+                meta.setdefault(row["date"], {})[(row["class"], row["year"], row["subject"])] = int(row["rows"])
+    return {"segments": segments, "meta": meta}
+
+def _archive_index():
+    return _cached(ARCHIVE_DIR, _read_archive_index)
+
+def _read_segment(path):
+    """Rows of one attendance segment grouped by date.
+
+    Only the last segment read is kept, which covers reading its days one
+    after another (newest first) without decompressing it again for each.
+    """
+    try:
+        stamp = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _index_lock:
+        hit = _segment_cache.get(path)
+        if hit is not None and hit[0] == stamp:
+            return hit[1]
+    by_date = {}
+    for row in _read_gzip_csv(path):
+        by_date.setdefault(row["time"][:10], []).append(row)
+    with _index_lock:
+        _segment_cache.clear()
+        _segment_cache[path] = (stamp, by_date)
+    return by_date
+
+def _by_month(rows, date_of):
+    months = {}
+    for row in rows:
+        months.setdefault(date_of(row)[:7], []).append(row)
+    return months.items()
+
+def _read_complete_rows(path):
+    """Rows of a CSV that is being appended to without its lock, ignoring a partly written last line."""
+    with open(path, "rb") as f:
+        data = f.read()
+    data = data[:data.rfind(b"\n") + 1]
+    return list(csv.DictReader(io.StringIO(data.decode("utf-8"), newline='')))
+
+def _compact_file(path, fieldnames, name):
+    """Archive the rows of a CSV keyed by "date" from before today. Returns rows archived.
+
+    The segments are built from a snapshot under the archive lock only; the
+    file's own lock, which every append needs, is held just for the final rewrite.
+    """
+    today = datetime.now().strftime("%Y-%m-%d")
+    with file_lock(ARCHIVE_DIR):
+        if not os.path.exists(path):
+            return 0
+        past = [r for r in _read_complete_rows(path) if r["date"] < today]
+        if not past:
+            return 0
+        archived = {tuple(r.get(k) for k in fieldnames) for r in past}
+        for month, month_rows in _by_month(past, lambda r: r["date"]):
+            keys = {tuple(r.get(k) for k in fieldnames) for r in month_rows}
+            _merge_segment(archive_path(name, month), fieldnames, month_rows,
+                           lambda r: tuple(r.get(k) for k in fieldnames) in keys)
+        # the archive is written first: a crash in between leaves rows in both, never in neither.
+        # Rows appended since the snapshot are kept, even late ones for a past date.
+        with file_lock(path):
+            with open(path, newline='', encoding="utf-8") as f:
+                rows = list(csv.DictReader(f))
+            _write_csv_atomic(path, fieldnames,
+                              [r for r in rows if tuple(r.get(k) for k in fieldnames) not in archived])
+    return len(past)
+
+def compact_tokens():
+    """Move tokens issued before today out of TOKEN_FILE; only today's tokens can still be used."""
+    archived = _compact_file(TOKEN_FILE, TOKEN_FIELDS, "tokens")
+    _sync_tokens()
+    return archived
+
+def compact_codes():
+    """Move past days' class codes out of CODE_FILE; load_codes still returns them."""
+    return _compact_file(CODE_FILE, CODE_FIELDS, "class_codes")
+
+def archive_attendance(retain_days=None):
+    """Move day partitions older than `retain_days` into monthly segments. Returns days archived.
+
+    Closed partitions are no longer appended to, so this takes the archive lock
+    rather than ATTEND_DIR's, which commit_attendance needs. `retain_days`
+    defaults to ATTEND_RETAIN_DAYS at call time.
+    """
+    if retain_days is None:
+        retain_days = ATTEND_RETAIN_DAYS
+    cutoff = (datetime.now() - timedelta(days=max(retain_days, 1))).strftime("%Y-%m-%d")
+    with file_lock(ARCHIVE_DIR):
+        dates = sorted(d for d in _partition_dates() if d < cutoff)
+        for month, days in _by_month(dates, lambda d: d):
+            days = set(days)
+            rows = []
+            for date in sorted(days):
+                rows.extend(_read_partition(date))
+            merged = _merge_segment(archive_path("attendance", month), ATTEND_FIELDS, rows,
+                                    lambda r: r["time"][:10] in days)
+            meta = {}
+            for row in merged:
+                key = (row["time"][:10], row["class"], row["year"], row["subject"])
+                meta[key] = meta.get(key, 0) + 1
+            _write_csv_atomic(os.path.join(ARCHIVE_DIR, f"attendance-{month}.meta.csv"), ARCHIVE_META_FIELDS,
+                              [dict(zip(ARCHIVE_META_FIELDS, key + (n,))) for key, n in sorted(meta.items())])
+            for date in days:
+                os.remove(attendance_path(date))
+                _drop_columns(date)
+                if os.path.exists(columns_path(date)):
+                    os.remove(columns_path(date))
+    return len(dates)
+
+def compact():
+    """Archive everything that is past its retention; safe to run while serving."""
+    return {"tokens": compact_tokens(), "codes": compact_codes(), "attendance": archive_attendance()}
+
+def maybe_compact():
+    """Start compact() in the background, at most once a day, when a hot file is due.
+
+    Rows only become archivable when the day changes, so checking more than
+    once a day would find nothing new to move.
+    """
+    today = datetime.now().strftime("%Y-%m-%d")
+    if _compacted[0] == today:
+        return
+    with _index_lock:
+        if _compacted[0] == today:
+            return
+        _compacted[0] = today
+    cutoff = (datetime.now() - timedelta(days=max(ATTEND_RETAIN_DAYS, 1))).strftime("%Y-%m-%d")
+    due = (any(os.path.exists(p) and os.path.getsize(p) > COMPACT_BYTES for p in (TOKEN_FILE, CODE_FILE))
+           or any(d < cutoff for d in _partition_dates()))
+    if due:
+        threading.Thread(target=compact, name="attendance-compact", daemon=True).start()
+
+# --------- Columnar partitions ----------
+# A closed day's partition is also kept as attendance/YYYY-MM-DD.bin: a header, one
+# little-endian uint32 column per ATTEND_FIELDS entry indexing a sorted string table, then
+# the table's offsets and UTF-8 bytes. The file is memory-mapped and filtered on the integer
+# columns, so only the rows actually returned become dicts. The CSV stays the source of
+# truth: the header records its size and mtime, and a stale copy is rebuilt from it.
+_BIN_MAGIC = b"ATTCOL1\n"
+_BIN_HEADER = struct.Struct("<8sQqII")  # magic, CSV size, CSV mtime_ns, rows, strings
+
+def columns_path(date):
+    return os.path.join(ATTEND_DIR, f"{date}.bin")
+
+def write_partition_columns(date):
+    """Write the columnar copy of one partition from its CSV. Returns the row count."""
+    st = os.stat(attendance_path(date))
+    rows = _read_partition(date)
+    # code point order is UTF-8 byte order, so the table can be binary searched as str
+    strings = sorted({row.get(k) or "" for row in rows for k in ATTEND_FIELDS})
+    index = {value: i for i, value in enumerate(strings)}
+    encoded = [value.encode("utf-8") for value in strings]
+    body = array("I")
+    for k in ATTEND_FIELDS:
+        body.extend(index[row.get(k) or ""] for row in rows)
+    offsets = array("I", [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    if sys.byteorder == "big":
+        body.byteswap()
+        offsets.byteswap()
+    fd, tmp_path = tempfile.mkstemp(dir=ATTEND_DIR, suffix=".tmp")
+    with timed("rewrite:" + ATTEND_DIR), os.fdopen(fd, "wb") as f:
+        f.write(_BIN_HEADER.pack(_BIN_MAGIC, st.st_size, st.st_mtime_ns, len(rows), len(strings)))
+        f.write(body.tobytes())
+        f.write(offsets.tobytes())
+        f.write(b"".join(encoded))
+        f.flush()
+        os.fsync(f.fileno())
+    _drop_columns(date)
+    os.replace(tmp_path, columns_path(date))
+    count("attendance_bytes_written_total", os.path.getsize(columns_path(date)), file=ATTEND_DIR, mode="columns")
+    return len(rows)
+
+_U32 = struct.Struct("<I")
+_U32_PAIR = struct.Struct("<II")
+_mapped_dates = []
+
+def _map_columns(date):
+    try:
+        with open(columns_path(date), "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    if len(buf) < _BIN_HEADER.size:
+        buf.close()
+        return None
+    magic, size, mtime_ns, rows, strings = _BIN_HEADER.unpack_from(buf)
+    if magic != _BIN_MAGIC:
+        buf.close()
+        return None
+    start = _BIN_HEADER.size
+    starts = {}
+    for k in ATTEND_FIELDS:
+        starts[k] = start
+        start += 4 * rows
+    # each mapping holds a descriptor: keep only the most recently mapped partitions
+    with _index_lock:
+        if date in _mapped_dates:
+            _mapped_dates.remove(date)
+        _mapped_dates.append(date)
+        evicted = _mapped_dates[:-COLUMNS_MAPPED] if len(_mapped_dates) > COLUMNS_MAPPED else []
+        del _mapped_dates[:len(evicted)]
+    for old in evicted:
+        _drop_columns(old)
+    return {
+        "source": (size, mtime_ns),
+        "rows": rows,
+        "strings": strings,
+        "starts": starts,
+        "offsets": start,
+        "blob": start + 4 * (strings + 1),
+        "buf": buf,
+        # held while the mapping is read, so _drop_columns never unmaps it mid-read
+        "lock": threading.Lock(),
+    }
+
+def _drop_columns(date):
+    """Forget and unmap a partition's columns.
+
+    Called before its .bin is replaced or removed: that releases the mapping's
+    descriptor, and Windows refuses both operations on a mapped file.
+    """
+    with _index_lock:
+        hit = _file_cache.pop((columns_path(date), _map_columns.__name__), None)
+    part = hit[1] if hit else None
+    if part is not None:
+        with part["lock"]:
+            try:
+                part["buf"].close()
+            except BufferError:
+                pass  # a column view is still referenced; unmapped once it is collected
+
+def partition_columns(date):
+    """Mapped columns of a closed partition, written on first use.
+
+    None for today's partition (still being appended to), when ATTEND_COLUMNS is
+    off, or on a big-endian host without NumPy; callers then read the CSV.
+    """
+    if not ATTEND_COLUMNS or date >= datetime.now().strftime("%Y-%m-%d"):
+        return None
+    if sys.byteorder == "big" and np is None:
+        return None
+    try:
+        st = os.stat(attendance_path(date))
+    except FileNotFoundError:
+        return None
+    part = _cached(columns_path(date), _map_columns, date)
+    if part is None or part["source"] != (st.st_size, st.st_mtime_ns):
+        # concurrent writers produce the same file, and os.replace keeps it whole
+        write_partition_columns(date)
+        part = _cached(columns_path(date), _map_columns, date)
+    if part is None or part["source"] != (st.st_size, st.st_mtime_ns):
+        return None  # the CSV changed while the copy was written
+    return part
+
+@contextmanager
+def _open_columns(date):
+    """partition_columns(date), locked against being unmapped while the block reads it.
+
+    Yields None when the CSV must be read instead.
+    """
+    part = partition_columns(date)
+    if part is None:
+        yield None
+        return
+    with part["lock"]:
+        yield None if part["buf"].closed else part
+
+def _uint32_column(part, k):
+    # a view (or copy) per call: no buffer export outlives the read, so the map can be closed
+    start = part["starts"][k]
+    if np is not None:
+        return np.frombuffer(part["buf"], dtype="<u4", count=part["rows"], offset=start)
+    column = array("I")
+    column.frombytes(part["buf"][start:start + 4 * part["rows"]])
+    return column
+
+def _column_string(part, i):
+    begin, end = _U32_PAIR.unpack_from(part["buf"], part["offsets"] + 4 * i)
+    return part["buf"][part["blob"] + begin:part["blob"] + end].decode("utf-8")
+
+def _column_lookup(part, value):
+    """Position of `value` in the partition's string table, or None."""
+    lo, hi = 0, part["strings"]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _column_string(part, mid) < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < part["strings"] and _column_string(part, lo) == value:
+        return lo
+    return None
+
+def _column_select(part, equals):
+    """Row numbers (ascending) whose fields equal every value in `equals`."""
+    wanted = {}
+    for k, value in equals.items():
+        i = _column_lookup(part, value)
+        if i is None:
+            return []
+        wanted[k] = i
+    if np is not None:
+        mask = np.ones(part["rows"], dtype=bool)
+        for k, i in wanted.items():
+            mask &= _uint32_column(part, k) == i
+        return np.flatnonzero(mask).tolist()
+    selected = range(part["rows"])
+    for k, i in wanted.items():
+        column = _uint32_column(part, k)
+        selected = [r for r in selected if column[r] == i]
+    return list(selected)
+
+def _column_row(part, r):
+    buf, starts = part["buf"], part["starts"]
+    return {k: _column_string(part, _U32.unpack_from(buf, starts[k] + 4 * r)[0]) for k in ATTEND_FIELDS}
+
+def _column_groups(part, fields):
+    """Distinct value combinations of `fields` with their row counts."""
+    columns = [_uint32_column(part, k) for k in fields]
+    if np is not None and part["rows"]:
+        keys, counts = np.unique(np.stack(columns, axis=1), axis=0, return_counts=True)
+        groups = list(zip(map(tuple, keys.tolist()), counts.tolist()))
+    else:
+        groups = list(Counter(zip(*columns)).items())
+    del columns
+    names = {i: _column_string(part, i) for key, _ in groups for i in key}
+    return {tuple(names[i] for i in key): n for key, n in groups}
+
+def _session_matches(key, filter_class, filter_year, filter_subject):
+    class_name, year, subject = key
+    return ((not filter_class or class_name == filter_class)
+            and (not filter_year or year == filter_year)
+            and (not filter_subject or subject == filter_subject))
+
+def _row_matches(row, filter_class, filter_year, filter_subject):
+    return _session_matches((row["class"], row["year"], row["subject"]), filter_class, filter_year, filter_subject)
+
+def _matching_dates(filter_date):
+    return [d for d in attendance_dates() if d.startswith(filter_date)]
+
+def count_attendance(filter_class="", filter_year="", filter_subject="", filter_date=""):
+    """Number of matching rows, answered from the partition metadata alone."""
+    total = 0
+    for date in _matching_dates(filter_date):
+        for key, n in partition_meta(date).items():
+            if _session_matches(key, filter_class, filter_year, filter_subject):
+                total += n
+    return total
+
+def iter_attendance(filter_class="", filter_year="", filter_subject="", filter_date="", offset=0, limit=None):
+    """Yield matching attendance rows newest first, opening only the partitions needed.
+
+    Partitions are skipped without being read when `filter_date` excludes them,
+    when their metadata has no matching session, or when all of their matching
+    rows fall before `offset`.
+    """
+    for date in _matching_dates(filter_date):
+        if limit is not None and limit <= 0:
+            return
+        matching = sum(n for key, n in partition_meta(date).items()
+                       if _session_matches(key, filter_class, filter_year, filter_subject))
+        if offset >= matching:
+            offset -= matching
+            continue
+        with _open_columns(date) as part:
+            if part is not None:
+                # filter on the mapped columns and decode only the rows on this page
+                equals = {k: v for k, v in (("class", filter_class), ("year", filter_year),
+                                            ("subject", filter_subject)) if v}
+                selected = _column_select(part, equals)
+                selected.reverse()
+                selected = selected[offset:] if limit is None else selected[offset:offset + limit]
+                rows = [_column_row(part, r) for r in selected]
+        if part is None:
+            rows = [r for r in _read_partition(date) if _row_matches(r, filter_class, filter_year, filter_subject)]
+            rows.reverse()
+            rows = rows[offset:] if limit is None else rows[offset:offset + limit]
+        offset = 0
+        if limit is not None:
+            limit -= len(rows)
+        yield from rows
+
+# attendance index: (id, class, year, subject, date, code) of every mark in today's
+# partition plus the ids marked today; rebuilt from the partition, then kept up to date on append
+_attend_keys = set()
+_marked_today = set()
+_attend_state = {}
+_attend_day = [None]
+# today's share of the aggregates: (id, class, year, subject) present, and students present per session
+_present_today = set()
+_session_today = {}
+# today's marks per (class, year, subject) as (id, name, time) in file order, for the live
+# view; positions are the same in every worker because they all read the same partition
+_session_marks = {}
+_marks_changed = threading.Condition(_index_lock)
+# aggregates over the partitions before "until": days present per (class, year, subject) and
+# student id, and students present per (class, year, subject) and date
+_agg = {"until": None, "student": {}, "session": {}}
+
+def _index_rows(rows):
+    for row in rows:
+        _attend_keys.add((row["id"], row["class"], row["year"], row["subject"], row["time"][:10], row["code"]))
+        _marked_today.add(row["id"])
+        present = (row["id"], row["class"], row["year"], row["subject"])
+        _session_marks.setdefault(present[1:], []).append((row["id"], row["name"], row["time"]))
+        if present not in _present_today:
+            _present_today.add(present)
+            _session_today[present[1:]] = _session_today.get(present[1:], 0) + 1
+
+def _clear_day():
+    _attend_keys.clear()
+    _marked_today.clear()
+    _present_today.clear()
+    _session_today.clear()
+    _session_marks.clear()
+
+def _fold_day(date, present, agg=_agg):
+    """Add one day's distinct (id, class, year, subject) marks to the history aggregates."""
+    for sid, class_name, year, subject in present:
+        key = (class_name, year, subject)
+        counts = agg["student"].setdefault(key, {})
+        counts[sid] = counts.get(sid, 0) + 1
+        per_date = agg["session"].setdefault(key, {})
+        per_date[date] = per_date.get(date, 0) + 1
+
+def _sync_attendance():
+    """Bring the attendance index up to date with today's partition (appended rows only)."""
+    today = datetime.now().strftime("%Y-%m-%d")
+    with _index_lock:
+        day = _attend_day[0]
+        if day != today:
+            if day is not None:
+                # finish the previous day and fold it into the history aggregates
+                rows, reset = _tail_csv(attendance_path(day), _attend_state)
+                if reset:
+                    _clear_day()
+                _index_rows(rows)
+                if _agg["until"] == day:
+                    _fold_day(day, _present_today)
+                    # days nobody requested in this process (weekends): fold each from its
+                    # partition instead of dropping the aggregates for a full rebuild
+                    gap = datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)
+                    while gap.strftime("%Y-%m-%d") < today:
+                        _fold_day(gap.strftime("%Y-%m-%d"), _partition_present(gap.strftime("%Y-%m-%d")))
+                        gap += timedelta(days=1)
+                    _agg["until"] = today
+            _clear_day()
+            _attend_state.clear()
+            _attend_day[0] = today
+        rows, reset = _tail_csv(attendance_path(today), _attend_state)
+        if reset:
+            _clear_day()
+        _index_rows(rows)
+        if rows or reset:
+            _marks_changed.notify_all()
+
+def attendance_exists(student_id, class_name, year, subject, date, code):
+    _sync_attendance()
+    key = (student_id, class_name, year, subject, date, code)
+    if date == _attend_day[0]:
+        return key in _attend_keys
+    # only today is indexed; other days are checked against their partition
+    with _open_columns(date) as part:
+        if part is not None:
+            return bool(_column_select(part, {"id": student_id, "class": class_name, "year": year,
+                                              "subject": subject, "code": code}))
+    return any((r["id"], r["class"], r["year"], r["subject"], r["time"][:10], r["code"]) == key
+               for r in _read_partition(date))
+
+def has_marked_today(student_id):
+    _sync_attendance()
+    return student_id in _marked_today
+
+def _ensure_aggregates():
+    """Build the history aggregates from the past partitions if they are missing."""
+    _sync_attendance()
+    with _index_lock:
+        today = _attend_day[0]
+        if _agg["until"] == today:
+            return
+    # built outside _index_lock, which every scan, mark and lock check needs
+    agg = {"student": {}, "session": {}}
+    for date in attendance_dates():
+        if date < today:
+            _fold_day(date, _partition_present(date), agg)
+    with _index_lock:
+        if _attend_day[0] == today and _agg["until"] != today:
+            _agg.update(until=today, **agg)
+
+def _partition_present(date):
+    """Distinct (id, class, year, subject) marks in one partition."""
+    with _open_columns(date) as part:
+        if part is not None:
+            return set(_column_groups(part, ("id", "class", "year", "subject")))
+    return {(r["id"], r["class"], r["year"], r["subject"]) for r in _read_partition(date)}
+
+def _session_dates(class_name, year, subject):
+    """Dates a class session was held on: every code created for it plus any day with attendance."""
+    key = (class_name, year, subject)
+    dates = set(_cached(CODE_FILE, _read_codes)["dates"].get(key, ()))
+    dates.update(_agg["session"].get(key, {}))
+    if _session_today.get(key):
+        dates.add(_attend_day[0])
+    return dates
+
+def student_summary(class_name, year, subject):
+    """Attendance percentage of every student on the class roster for one subject."""
+    _ensure_aggregates()
+    roster = _cached(STUDENT_FILE, _read_roster)
+    key = (class_name, year, subject)
+    with _index_lock:
+        held = len(_session_dates(class_name, year, subject))
+        counts = _agg["student"].get(key, {})
+        summary = []
+        for sid in roster["by_class"].get(class_name, []):
+            present = counts.get(sid, 0) + ((sid,) + key in _present_today)
+            summary.append({
+                "id": sid,
+                "name": roster["students"][sid]["name"],
+                "present": present,
+                "held": held,
+                "percent": round(100 * present / held, 1) if held else 0.0,
+            })
+    return summary
+
+def session_summary(class_name, year, subject):
+    """Present/absent counts for each session of a class subject, newest first."""
+    _ensure_aggregates()
+    roster_size = len(_cached(STUDENT_FILE, _read_roster)["by_class"].get(class_name, []))
+    key = (class_name, year, subject)
+    with _index_lock:
+        per_date = dict(_agg["session"].get(key, {}))
+        per_date[_attend_day[0]] = _session_today.get(key, 0)
+        return [{"date": date, "present": per_date.get(date, 0), "absent": max(roster_size - per_date.get(date, 0), 0)}
+                for date in sorted(_session_dates(class_name, year, subject), reverse=True)]
+
+def commit_attendance(entries):
+    """Record attendance rows and consume their tokens as one unit.
+
+    Each entry is an attendance row (ATTEND_FIELDS) plus its "token" (the key
+    returned by check_token). Token and
+    duplicate checks are repeated under the file locks, so concurrent workers
+    cannot both accept the same token or the same student twice. Returns one
+    status per entry: "ok", "used_token" or "duplicate".
+    """
+    results = []
+    with timed("commit"), file_lock(ATTEND_DIR), file_lock(TOKEN_FILE):
+        _sync_tokens()
+        accepted = []
+        seen_tokens, seen_keys = set(), set()
+        for entry in entries:
+            key = (entry["id"], entry["class"], entry["year"], entry["subject"],
+                   entry["time"][:10], entry["code"])
+            if not _token_available(entry["token"]) or entry["token"] in seen_tokens:
+                results.append("used_token")
+            elif key in seen_keys or attendance_exists(*key):
+                results.append("duplicate")
+            else:
+                seen_tokens.add(entry["token"])
+                seen_keys.add(key)
+                accepted.append(entry)
+                results.append("ok")
+        if accepted:
+            by_path = {}
+            for entry in accepted:
+                by_path.setdefault(attendance_path(entry["time"][:10]), []).append(entry)
+            sizes = {}
+            os.makedirs(ATTEND_DIR, exist_ok=True)
+            try:
+                for path, rows in by_path.items():
+                    sizes[path] = os.path.getsize(path) if os.path.exists(path) else 0
+                    _append_csv(path, ATTEND_FIELDS, rows, sync=True)
+                _append_csv(TOKEN_FILE, TOKEN_FIELDS, [{
+                    "token": e["token"],
+                    "class": e["class"],
+                    "year": e["year"],
+                    "subject": e["subject"],
+                    "date": e["time"][:10],
+                    "used": "1",
+                    "student_id": e["id"],
+                } for e in accepted], sync=True)
+            except Exception:
+                # roll the attendance rows back so neither half is committed
+                for path, size in sizes.items():
+                    with open(path, "r+b") as f:
+                        f.truncate(size)
+                raise
+    _sync_tokens()
+    _sync_attendance()
+    for status in results:
+        count("attendance_marks_total", status=status)
+    return results
+
+# group commit: requests hand their entries to one writer thread per process, which
+# merges whatever arrives within GROUP_COMMIT_MS into a single commit_attendance call
+_commit_queue = queue.Queue()
+_writer = {"pid": None, "thread": None}
+# guards each job's "state": queued -> taken by a writer, or queued -> abandoned by its request
+_claim_lock = threading.Lock()
+
+def _claim(job):
+    """Take a queued job for this writer; False if its request has already given up on it."""
+    with _claim_lock:
+        if job["state"] == "abandoned":
+            return False
+        job["state"] = "taken"
+        job["writer"] = threading.current_thread()
+        return True
+
+def _group_commit_loop():
+    while True:
+        job = _commit_queue.get()
+        if not _claim(job):
+            continue
+        batch = [job]
+        rows = len(job["entries"])
+        deadline = time.monotonic() + GROUP_COMMIT_MS / 1000
+        while rows < GROUP_COMMIT_ROWS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = _commit_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if _claim(job):
+                batch.append(job)
+                rows += len(job["entries"])
+        try:
+            count("attendance_group_commits_total")
+            count("attendance_group_commit_rows_total", rows)
+            statuses = commit_attendance([e for job in batch for e in job["entries"]])
+        except Exception as exc:
+            for job in batch:
+                job["error"] = exc
+                job["done"].set()
+            continue
+        # hand each request its slice of the results once the rows are on disk
+        for job in batch:
+            job["statuses"], statuses = statuses[:len(job["entries"])], statuses[len(job["entries"]):]
+            job["done"].set()
+
+def _ensure_writer():
+    # started lazily and per process, so forked workers each get their own thread;
+    # restarted if it has died
+    with _index_lock:
+        thread = _writer["thread"]
+        if _writer["pid"] != os.getpid() or thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_group_commit_loop, name="attendance-writer", daemon=True)
+            thread.start()
+            _writer.update(pid=os.getpid(), thread=thread)
+
+def submit_attendance(entries):
+    """Commit entries like commit_attendance, grouped with concurrent requests.
+
+    Returns only after the group containing these entries has been written
+    and fsynced, so the response still acknowledges a durable write. Raises
+    RuntimeError only when the rows are known not to be written: no writer
+    took them within GROUP_COMMIT_TIMEOUT (they are withdrawn), or the writer
+    that took them died.
+    """
+    if not GROUP_COMMIT or not entries:
+        return commit_attendance(entries)
+    _ensure_writer()
+    job = {"entries": entries, "done": threading.Event(), "state": "queued"}
+    _commit_queue.put(job)
+    deadline = time.monotonic() + GROUP_COMMIT_TIMEOUT
+    with timed("commit_wait"):
+        while not job["done"].wait(1):
+            # a writer that died takes no more jobs; start another for whatever is queued
+            _ensure_writer()
+            with _claim_lock:
+                if job["state"] == "queued" and time.monotonic() >= deadline:
+                    # withdraw the rows so no writer commits them after the request has failed
+                    job["state"] = "abandoned"
+                    raise RuntimeError("attendance writer did not take the commit in time")
+            # once taken, the commit is in progress: wait for its result however long it takes
+            if job["state"] == "taken" and not job["writer"].is_alive() and not job["done"].is_set():
+                raise RuntimeError("attendance writer died during the commit")
+    if "error" in job:
+        raise job["error"]
+    return job["statuses"]
 
 def load_classes():
-    classes = set()
-    if os.path.exists(STUDENT_FILE):
-        with open(STUDENT_FILE, newline='', encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                classes.add(row["class"])
-    return sorted(list(classes))
+    return _cached(STUDENT_FILE, _read_roster)["classes"]
+
+PASSWORD_SCHEME = "pbkdf2_sha256"
+_login_buckets = {}
+_login_lock = threading.Lock()
+
+def hash_password(password, iterations=None):
+    iterations = iterations or PASSWORD_ITERATIONS
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return "$".join([PASSWORD_SCHEME, str(iterations),
+                     base64.urlsafe_b64encode(salt).decode(), base64.urlsafe_b64encode(digest).decode()])
+
+def verify_password(password, stored):
+    if not stored.startswith(PASSWORD_SCHEME + "$"):
+        # plaintext row not converted yet (flask --app app hash-passwords)
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        salt, digest, iterations = base64.urlsafe_b64decode(salt), base64.urlsafe_b64decode(digest), int(iterations)
+    except ValueError:
+        return False
+    candidate = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return hmac.compare_digest(candidate, digest)
 
-def check_teacher(username, password):
+@lru_cache(maxsize=1)
+def _dummy_hash():
+    return hash_password(generate_token(16))
+
+def _read_teachers():
+    teachers = {}
     if os.path.exists(TEACHER_FILE):
         with open(TEACHER_FILE, newline='', encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["username"] == username and row["password"] == password:
-                    return True
-    return False
+            for row in csv.DictReader(f):
+                teachers[row["username"]] = row["password"]
+    return teachers
 
-def is_student_locked(student_id):
-    if not os.path.exists(LOCK_FILE):
-        return False, None
-    new_rows = []
-    locked = False
-    unlock_time = None
+def check_teacher(username, password):
+    stored = _cached(TEACHER_FILE, _read_teachers).get(username)
+    with timed("password_check"):
+        if stored is None:
+            # hash anyway so an unknown username takes as long as a wrong password
+            verify_password(password, _dummy_hash())
+            return False
+        return verify_password(password, stored)
+
+def rate_limit(key, per_minute=None, burst=None):
+    """Take one attempt from `key`'s token bucket.
+
+    Returns 0 when the attempt is allowed, otherwise the seconds until the
+    bucket holds a token again. The limits default to LOGIN_ATTEMPTS_PER_MINUTE
+    and LOGIN_BURST.
+    """
+    per_minute = per_minute or LOGIN_ATTEMPTS_PER_MINUTE
+    burst = burst or LOGIN_BURST
+    now = time.monotonic()
+    refill = per_minute / 60
+    with _login_lock:
+        if len(_login_buckets) >= LOGIN_BUCKETS_MAX:
+            # drop buckets that have refilled completely; they behave like new ones
+            full = burst / refill
+            for k in [k for k, (_, last) in _login_buckets.items() if now - last >= full]:
+                del _login_buckets[k]
+        tokens, last = _login_buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * refill)
+        if tokens < 1:
+            _login_buckets[key] = (tokens, now)
+            return (1 - tokens) / refill
+        _login_buckets[key] = (tokens - 1, now)
+        return 0
+
+def rate_limit_refund(key, burst=None):
+    """Give back the attempt rate_limit took, for an attempt that turned out fine."""
+    burst = burst or LOGIN_BURST
+    with _login_lock:
+        if key in _login_buckets:
+            tokens, last = _login_buckets[key]
+            _login_buckets[key] = (min(burst, tokens + 1), last)
+
+# lock table: student_id -> unlock time, plus a heap ordered by unlock time for lazy expiry.
+# lock.csv is an append-only log (latest row per student wins) that is compacted periodically.
+_locks = {}
+_lock_heap = []
+_lock_state = {}
+_lock_stats = {"rows": 0, "compacted": 0.0}
+
+def _sync_locks():
     now = datetime.now()
-    with open(LOCK_FILE, newline='', encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            row_unlock_time = datetime.strptime(row["unlock_time"], "%Y-%m-%d %H:%M:%S")
-            if row["student_id"] == student_id:
-                if now < row_unlock_time:
-                    locked = True
-                    unlock_time = row_unlock_time
-                # skip expired lock (remove it)
-            else:
-                if now < row_unlock_time:
-                    new_rows.append(row)
-
-    # rewrite lock file with only valid locks
-    with open(LOCK_FILE, "w", newline='', encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=["student_id", "unlock_time"])
-        writer.writeheader()
-        writer.writerows(new_rows)
-
-    return locked, unlock_time
-
-def lock_student(student_id, minutes=40):
-    unlock_time = datetime.now() + timedelta(minutes=minutes)
-    rows = []
-    if os.path.exists(LOCK_FILE):
-        with open(LOCK_FILE, newline='', encoding="utf-8") as f:
-            rows = list(csv.DictReader(f))
+    with _index_lock:
+        rows, reset = _tail_csv(LOCK_FILE, _lock_state)
+        if reset:
+            _locks.clear()
+            _lock_heap.clear()
+            _lock_stats["rows"] = 0
+        for row in rows:
+            unlock_time = datetime.strptime(row["unlock_time"], "%Y-%m-%d %H:%M:%S")
+            _locks[row["student_id"]] = unlock_time
+            heapq.heappush(_lock_heap, (unlock_time, row["student_id"]))
+            _lock_stats["rows"] += 1
+        # drop expired locks; a heap entry is stale if a newer row replaced it
+        while _lock_heap and _lock_heap[0][0] <= now:
+            unlock_time, student_id = heapq.heappop(_lock_heap)
+            if _locks.get(student_id) == unlock_time:
+                del _locks[student_id]
+
+def _compact_locks():
+    """Rewrite lock.csv with only the live locks once dead rows dominate it."""
+    if _lock_stats["rows"] <= 2 * len(_locks) + 100 or time.time() - _lock_stats["compacted"] < LOCK_COMPACT_SECONDS:
+        return
+    with file_lock(LOCK_FILE):
+        _sync_locks()
+        with _index_lock:
+            live = [{"student_id": sid, "unlock_time": t.strftime("%Y-%m-%d %H:%M:%S")} for sid, t in _locks.items()]
+            _lock_stats["compacted"] = time.time()
+        _write_csv_atomic(LOCK_FILE, LOCK_FIELDS, live)
+    _sync_locks()
 
-    rows.append({"student_id": student_id, "unlock_time": unlock_time.strftime("%Y-%m-%d %H:%M:%S")})
-    with open(LOCK_FILE, "w", newline='', encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=["student_id", "unlock_time"])
-        writer.writeheader()
-        writer.writerows(rows)
+def is_student_locked(student_id):
+    _sync_locks()
+    unlock_time = _locks.get(student_id)
+    if unlock_time and datetime.now() < unlock_time:
+        return True, unlock_time
+    return False, None
+
+def lock_students(student_ids, minutes=None):
+    # LOCK_MINUTES is read per call, as set_device_cookies does, so both locks stay the same length
+    if minutes is None:
+        minutes = LOCK_MINUTES
+    unlock_time = (datetime.now() + timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S")
+    with file_lock(LOCK_FILE):
+        _append_csv(LOCK_FILE, LOCK_FIELDS, [
+            {"student_id": student_id, "unlock_time": unlock_time} for student_id in student_ids
+        ])
+    _sync_locks()
+    _compact_locks()
+
+def lock_student(student_id, minutes=None):
+    lock_students([student_id], minutes)
+
+def unlock_student(student_id):
+    # a row that is already expired supersedes the student's current lock
+    lock_student(student_id, minutes=0)
 
 def generate_unlock_token(student_id):
     expiry = int(time.time()) + 300  # token valid for 5 minutes
@@ -181,6 +1416,50 @@ def verify_unlock_token(token):
     except Exception:
         return None
     
+def qr_digest(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_png(url, persist=True):
+    """PNG bytes of the QR code for `url`: from memory, then disk, encoding only on a miss.
+
+    Short-lived payloads (rotating frames) pass persist=False and stay in memory only.
+    """
+    path = os.path.join(QR_DIR, qr_digest(url) + ".png")
+    if persist and os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    buf = io.BytesIO()
+    with timed("qr_encode"):
+        qrcode.make(url).save(buf, format="PNG")
+    data = buf.getvalue()
+    if not persist:
+        return data
+    os.makedirs(QR_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=QR_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return data
+
+# digest -> payload, so /qr_image can re-encode an image that fell out of the LRU
+_qr_payloads = {}
+
+def qr_image_url(url):
+    """URL of the cached QR image for `url`.
+
+    The image is written to QR_DIR before the URL is handed out, so
+    the fetch can be served by any worker, not only the one that rendered the page.
+    """
+    digest = qr_digest(url)
+    if not os.path.exists(os.path.join(QR_DIR, digest + ".png")):
+        qr_png(url)
+    with _index_lock:
+        _qr_payloads[digest] = url
+        if len(_qr_payloads) > 4 * QR_CACHE_SIZE:
+            del _qr_payloads[next(iter(_qr_payloads))]
+    return url_for("qr_image", digest=digest)
+
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371000  # meters
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
@@ -189,7 +1468,121 @@ def haversine(lat1, lon1, lat2, lon2):
     a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
     return 2 * R * math.atan2(math.sqrt(a), math.sqrt(1-a))
 
+def _parse_coord(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+def verify_geofence_batch(submissions, radius=None):
+    """Check many submissions against their session's teacher location in one pass.
+
+    Each submission is a dict with class, year, subject, date, lat and lng.
+    Returns one (ok, distance) pair per submission. The distance is None when
+    no check was possible: a missing location is allowed, while coordinates
+    that don't parse fail. `radius` defaults to GEOFENCE_RADIUS at call time.
+    """
+    if radius is None:
+        radius = GEOFENCE_RADIUS
+    results = [(True, None)] * len(submissions)
+    checked, centres, points = [], [], []
+    for i, sub in enumerate(submissions):
+        centre = session_location(sub["class"], sub["year"], sub["subject"], sub["date"])
+        if centre is None or not sub.get("lat") or not sub.get("lng"):
+            continue
+        checked.append(i)
+        centres.append(centre)
+        points.append((_parse_coord(sub["lat"]), _parse_coord(sub["lng"])))
+    if not checked:
+        return results
+    with timed("geofence"):
+        if np is not None and len(checked) > 16:
+            c = np.radians(np.array(centres))
+            p = np.radians(np.array(points))
+            a = (np.sin((p[:, 0] - c[:, 0]) / 2) ** 2
+                 + np.cos(c[:, 0]) * np.cos(p[:, 0]) * np.sin((p[:, 1] - c[:, 1]) / 2) ** 2)
+            distances = (2 * 6371000 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))).tolist()
+        else:
+            distances = [haversine(c[0], c[1], p[0], p[1]) for c, p in zip(centres, points)]
+    for i, distance in zip(checked, distances):
+        if math.isnan(distance):
+            results[i] = (False, None)
+        else:
+            results[i] = (distance <= radius, distance)
+    return results
+
 # --------- Routes ----------
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    g.stages = []
+
+@app.before_request
+def schedule_compaction():
+    maybe_compact()
+
+@app.after_request
+def record_timing(response):
+    if "start" not in g:
+        return response
+    elapsed = time.perf_counter() - g.start
+    route = request.endpoint or "unmatched"
+    observe("attendance_request_seconds", elapsed, route=route, method=request.method)
+    count("attendance_requests_total", route=route, method=request.method, status=str(response.status_code))
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        # streamed pages (/teacher, exports) are timed up to the first chunk only
+        stages = ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in g.stages)
+        app.logger.warning("slow request %s %s %.1fms [%s]", request.method, request.full_path.rstrip("?"),
+                           elapsed * 1000, stages or "no stages")
+    return response
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+@app.route("/metrics")
+def metrics():
+    """Counters, latency histograms and index sizes in Prometheus text format."""
+    with _metrics_lock:
+        counters = dict(_counters)
+        histograms = {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]}
+                      for k, v in _histograms.items()}
+    lines = []
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), hist in sorted(histograms.items()):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        for bound, value in zip(_BUCKETS, hist["buckets"]):
+            lines.append(f"{name}_bucket{_format_labels(labels, le=bound)} {value}")
+        lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {hist["count"]}')
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+    # ✅ Index sizes, read without syncing so a scrape never touches the files
+    qr = qr_png.cache_info()
+    gauges = {
+        "attendance_tokens_indexed": len(_tokens),
+        "attendance_keys_indexed": len(_attend_keys),
+        "attendance_locks_indexed": len(_locks),
+        "attendance_file_cache_entries": len(_file_cache),
+        "attendance_qr_cache_entries": qr.currsize,
+        "attendance_qr_cache_hits": qr.hits,
+        "attendance_qr_cache_misses": qr.misses,
+        "attendance_commit_queue_depth": _commit_queue.qsize(),
+    }
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
 @app.route("/")
 def index():
     # check if locked
@@ -207,13 +1600,12 @@ def index():
     token = None
 
     if class_name and year and subject and class_code:
-        valid_code = get_today_code(class_name, year, subject)
-        if valid_code and valid_code == class_code:
-            token = generate_token()
-            save_token(token, class_name, year, subject)
+        if code_is_valid(class_name, year, subject, class_code):
+            token = issue_token(class_name, year, subject)
 
     classes = load_classes()
     return render_template("index.html",
+                           mark_batch_limit=MARK_BATCH_LIMIT,
                            classes=classes,
                            class_name=class_name,
                            year=year,
@@ -221,94 +1613,145 @@ def index():
                            class_code=class_code,
                            token=token)
 
-@app.route("/mark", methods=["POST"])
-def mark():
-    
-    student_id = request.form["student_id"].strip()
-    input_code = request.form["class_code"].strip()
-    class_name = request.form["class_name"]
-    year = request.form["year"].strip()
-    subject = request.form["subject"].strip()
-    token = request.form.get("token", "")
+SUBMISSION_FIELDS = ["student_id", "class_code", "class_name", "year", "subject", "token", "student_lat", "student_lng"]
 
-    # ✅ NEW: get student location from form
-    student_lat = request.form.get("student_lat")
-    student_lng = request.form.get("student_lng")
+def validate_submissions(submissions, now, cookie_sid=None):
+    """Run the /mark checks over a list of submissions (dicts of SUBMISSION_FIELDS).
 
-    now = datetime.now()
+    Returns one (entry, status, message, unlock_time) per submission: entry is
+    the row to pass to commit_attendance when every check passed, otherwise None
+    and status/message say which check failed; unlock_time is set for "locked".
+    A device marks for one student only: without a `cookie_sid`, the first
+    accepted submission claims it.
+    """
     students = load_students()
-
-    # ✅ Step 0: Check teacher location from CODE_FILE
-    teacher_lat, teacher_lng = None, None
-    if os.path.exists(CODE_FILE):
-        with open(CODE_FILE, newline='', encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row["class"] == class_name and row["year"] == year and row["subject"] == subject:
-                    teacher_lat = row.get("lat")
-                    teacher_lng = row.get("lng")
-                    break
-
-    # ✅ Step 0.1: If teacher location exists, verify student's location
-    if teacher_lat and teacher_lng and student_lat and student_lng:
-        try:
-            distance = haversine(float(teacher_lat), float(teacher_lng),
-                                 float(student_lat), float(student_lng))
-            if distance > 100:
-                return render_template("message.html",
-                                       message=f"❌ You are too far from teacher. (Distance: {int(distance)}m)")
-        except Exception as e:
-            return render_template("message.html", message="⚠️ Location check failed. Try again.")
-
-    # ✅ Step 1: Check cookie student_id (device lock)
-    cookie_sid = request.cookies.get("sid")
-    if cookie_sid and cookie_sid != student_id:
-        return render_template("message.html", message=f"❌ This device is locked for Student ID {cookie_sid}. You cannot mark for another student.")
-
-    # ✅ Step 2: Validate student
-    if student_id not in students:
-        return render_template("message.html", message="❌ Invalid Student ID")
-
-    if students[student_id]["class"] != class_name:
-        return render_template("message.html", message="❌ Wrong class for this Student ID")
-
-    valid_code = get_today_code(class_name, year, subject)
-    if not valid_code or input_code != valid_code:
-        return render_template("message.html", message="❌ Invalid or expired class code")
-
-    if not token or not token_is_valid(token):
-        return render_template("message.html", message="❌ Invalid or used token. Refresh QR page and try again.")
-
-    # ✅ Step 3: Prevent duplicate attendance
-    if os.path.exists(ATTEND_FILE):
-        with open(ATTEND_FILE, newline='', encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if (
-                    row["id"] == student_id
-                    and row["class"] == class_name
-                    and row["year"] == year
-                    and row["subject"] == subject
-                    and row["time"].startswith(datetime.now().strftime("%Y-%m-%d"))
-                    and row["code"] == input_code
-                ):
-                    return render_template("message.html",
-                                           message=f"⚠️ Attendance already marked for {students[student_id]['name']} today.")
-
-    # ✅ Step 4: Save attendance
-    with open(ATTEND_FILE, "a", newline='', encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([student_id, students[student_id]["name"], class_name, year, subject,
-                         now.strftime("%Y-%m-%d %H:%M:%S"), input_code])
-
-    mark_token_used(token, student_id)
-
+    subs = [{k: str(sub.get(k) or "").strip() for k in SUBMISSION_FIELDS} for sub in submissions]
+    today = now.strftime("%Y-%m-%d")
+
+    # ✅ Step 0: If today's session has a teacher location, verify student's location
+    locations = verify_geofence_batch([{
+        "class": sub["class_name"], "year": sub["year"], "subject": sub["subject"],
+        "date": today, "lat": sub["student_lat"], "lng": sub["student_lng"],
+    } for sub in subs])
+
+    results = []
+    for sub, (location_ok, distance) in zip(subs, locations):
+        student_id, class_name, year, subject = sub["student_id"], sub["class_name"], sub["year"], sub["subject"]
+        if not location_ok:
+            if distance is None:
+                results.append((None, "location_error", "⚠️ Location check failed. Try again.", None))
+            else:
+                results.append((None, "too_far", f"❌ You are too far from teacher. (Distance: {int(distance)}m)", None))
+            continue
+
+        # ✅ Step 1: Check cookie student_id (device lock)
+        if cookie_sid and cookie_sid != student_id:
+            results.append((None, "device_locked", f"❌ This device is locked for Student ID {cookie_sid}. You cannot mark for another student.", None))
+            continue
+
+        # ✅ Step 2: Validate student
+        if student_id not in students:
+            results.append((None, "invalid_student", "❌ Invalid Student ID", None))
+            continue
+        if students[student_id]["class"] != class_name:
+            results.append((None, "wrong_class", "❌ Wrong class for this Student ID", None))
+            continue
+
+        # ✅ Step 2.1: Server-side lock (survives cleared cookies)
+        locked, unlock_time = is_student_locked(student_id)
+        if locked:
+            results.append((None, "locked", f"⏳ Attendance locked until {unlock_time.strftime('%H:%M:%S')}", unlock_time))
+            continue
+
+        if not code_is_valid(class_name, year, subject, sub["class_code"], grace=ROTATE_MARK_GRACE):
+            results.append((None, "invalid_code", "❌ Invalid or expired class code", None))
+            continue
+        # rotating codes change every frame, so the session is recorded under its daily code
+        record_code = (get_today_code(class_name, year, subject) or ROTATING_CODE_LABEL) if ROTATE_CODES else sub["class_code"]
+
+        token_key = check_token(sub["token"], class_name, year, subject)
+        if token_key is None:
+            results.append((None, "used_token", "❌ Invalid or used token. Refresh QR page and try again.", None))
+            continue
+
+        cookie_sid = cookie_sid or student_id
+        results.append(({
+            "id": student_id,
+            "name": students[student_id]["name"],
+            "class": class_name,
+            "year": year,
+            "subject": subject,
+            "time": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "code": record_code,
+            "token": token_key,
+        }, "ok", None, None))
+    return results
+
+def commit_message(entry, status, now):
+    if status == "duplicate":
+        return f"⚠️ Attendance already marked for {entry['name']} today."
+    if status == "used_token":
+        return "❌ Invalid or used token. Refresh QR page and try again."
+    return f"✅ Attendance marked for {entry['name']} at {now.strftime('%H:%M:%S')} (Location OK)."
+
+def set_device_cookies(resp, student_id, now):
     # ✅ Step 5: Set cookie with student ID + lock
-    resp = make_response(render_template("message.html",
-                           message=f"✅ Attendance marked for {students[student_id]['name']} at {now.strftime('%H:%M:%S')} (Location OK)."))
     resp.set_cookie("sid", student_id, max_age=60*60*24*365)  # 1-year device lock
-    unlock_time = (now + timedelta(minutes=40)).strftime("%Y-%m-%d %H:%M:%S")
-    resp.set_cookie("lock_until", unlock_time, max_age=60*40)
+    unlock_time = (now + timedelta(minutes=LOCK_MINUTES)).strftime("%Y-%m-%d %H:%M:%S")
+    resp.set_cookie("lock_until", unlock_time, max_age=60*LOCK_MINUTES)
+    return resp
+
+@app.route("/mark", methods=["POST"])
+def mark():
+    now = datetime.now()
+    entry, status, message, unlock_time = validate_submissions([request.form], now, request.cookies.get("sid"))[0]
+    if entry is None:
+        if status == "locked":
+            return render_template("locked.html", unlock_time=unlock_time.strftime("%H:%M:%S"))
+        return render_template("message.html", message=message)
+
+    # ✅ Step 3+4: Save attendance and consume the token in one commit (duplicates rejected under the lock)
+    status = submit_attendance([entry])[0]
+    message = commit_message(entry, status, now)
+    if status != "ok":
+        return render_template("message.html", message=message)
+    lock_student(entry["id"])
+    return set_device_cookies(make_response(render_template("message.html", message=message)), entry["id"], now)
+
+@app.route("/mark/batch", methods=["POST"])
+def mark_batch():
+    """Accept many submissions as JSON ({"submissions": [...]}) and commit them together.
+
+    Used by the offline queue in index.html. Every submission carries its own
+    scan token; results come back per item, in order.
+    """
+    payload = request.get_json(silent=True)
+    submissions = payload.get("submissions") if isinstance(payload, dict) else None
+    if not isinstance(submissions, list) or not all(isinstance(sub, dict) for sub in submissions):
+        return jsonify(error="expected {\"submissions\": [...]}"), 400
+    if len(submissions) > MARK_BATCH_LIMIT:
+        return jsonify(error=f"at most {MARK_BATCH_LIMIT} submissions per batch"), 413
+
+    now = datetime.now()
+    checked = validate_submissions(submissions, now, request.cookies.get("sid"))
+    entries = [entry for entry, _, _, _ in checked if entry is not None]
+    # one append to the attendance partition and one to the token store for the whole batch
+    statuses = iter(submit_attendance(entries))
+    results, marked = [], []
+    for entry, status, message, _ in checked:
+        if entry is not None:
+            status = next(statuses)
+            message = commit_message(entry, status, now)
+            if status == "ok":
+                marked.append(entry["id"])
+        results.append({"status": status, "message": message})
+    if marked:
+        lock_students(marked)
+
+    resp = jsonify(results=results)
+    if marked:
+        # validate_submissions accepts a single student per device
+        set_device_cookies(resp, marked[0], now)
     return resp
 
 # --- Teacher Authentication ---
@@ -318,10 +1761,25 @@ def login():
         username = request.form["username"]
         password = request.form["password"]
 
+        # ✅ Throttle per client and per account before spending CPU on the hash.
+        # The attempt is taken up front so parallel guesses can't all get through, and
+        # given back on success: only failed logins count against the limits.
+        ip_key, user_key = ("ip", request.remote_addr or ""), ("user", username)
+        wait = (rate_limit(ip_key, LOGIN_IP_ATTEMPTS_PER_MINUTE, LOGIN_IP_BURST)
+                or rate_limit(user_key))
+        if wait:
+            count("attendance_logins_total", result="throttled")
+            return ("<h2>⏳ Too many login attempts, try again shortly</h2><a href='/login'>Back</a>",
+                    429, {"Retry-After": str(math.ceil(wait))})
+
         if check_teacher(username, password):
+            rate_limit_refund(ip_key, LOGIN_IP_BURST)
+            rate_limit_refund(user_key)
+            count("attendance_logins_total", result="ok")
             session["teacher"] = username
             return redirect(url_for("teacher"))
         else:
+            count("attendance_logins_total", result="failed")
             return "<h2>❌ Invalid Credentials</h2><a href='/login'>Try Again</a>"
 
     return render_template("login.html")
@@ -339,40 +1797,39 @@ def login_required(func):
     wrapper.__name__ = func.__name__
     return wrapper
 
+def attendance_filters():
+    # get filter values from query string (?class=...&year=...&subject=...&date=...)
+    return (request.args.get("class", "").strip(),
+            request.args.get("year", "").strip(),
+            request.args.get("subject", "").strip(),
+            request.args.get("date", "").strip())
+
 @app.route("/teacher")
 @login_required
 def teacher():
-    # get filter values from query string (?class=...&year=...&subject=...&date=...)
-    filter_class = request.args.get("class", "").strip()
-    filter_year = request.args.get("year", "").strip()
-    filter_subject = request.args.get("subject", "").strip()
-    filter_date = request.args.get("date", "").strip()
+    filter_class, filter_year, filter_subject, filter_date = attendance_filters()
+    page = max(request.args.get("page", 1, type=int), 1)
 
-    records = []
-    if os.path.exists(ATTEND_FILE):
-        with open(ATTEND_FILE, newline='', encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                match = True
-                if filter_class and row["class"] != filter_class:
-                    match = False
-                if filter_year and row["year"] != filter_year:
-                    match = False
-                if filter_subject and row["subject"] != filter_subject:
-                    match = False
-                if filter_date and not row["time"].startswith(filter_date):
-                    match = False
-                if match:
-                    records.append(row)
-
-    # get dropdown values
-    classes = load_classes()
-    subjects = sorted({r["subject"] for r in records}) if records else []
-    years = sorted({r["year"] for r in records}) if records else []
+    total = count_attendance(filter_class, filter_year, filter_subject, filter_date)
+    records = iter_attendance(filter_class, filter_year, filter_subject, filter_date,
+                              offset=(page - 1) * PAGE_SIZE, limit=PAGE_SIZE)
 
-    return render_template(
+    # get dropdown values (from partition metadata, no rows are read)
+    classes = load_classes()
+    session_keys = set()
+    for date in _matching_dates(filter_date):
+        session_keys.update(k for k in partition_meta(date)
+                            if _session_matches(k, filter_class, filter_year, filter_subject))
+    subjects = sorted({k[2] for k in session_keys})
+    years = sorted({k[1] for k in session_keys})
+
+    # stream the page so rows are rendered as the partitions are read
+    return stream_template(
         "teacher.html",
         attendance=records,
+        total=total,
+        page=page,
+        pages=max((total + PAGE_SIZE - 1) // PAGE_SIZE, 1),
         teacher=session["teacher"],
         classes=classes,
         subjects=subjects,
@@ -383,6 +1840,84 @@ def teacher():
         filter_date=filter_date,
     )
 
+def _export_csv(rows, chunk_rows=500):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(ATTEND_FIELDS)
+    for n, row in enumerate(rows, 1):
+        writer.writerow([row[k] for k in ATTEND_FIELDS])
+        if n % chunk_rows == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def _export_xlsx(rows, chunk_size=64 * 1024):
+    # write-only mode streams rows to a temp file instead of building the sheet in memory
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Attendance")
+    ws.append(ATTEND_FIELDS)
+    for row in rows:
+        ws.append([row[k] for k in ATTEND_FIELDS])
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+@app.route("/teacher/export")
+@login_required
+def export_attendance():
+    filters = attendance_filters()
+    fmt = request.args.get("format", "csv")
+    rows = iter_attendance(*filters)
+    # filter values are user input; keep quotes and line breaks out of the header
+    name = secure_filename("_".join(["attendance"] + [f for f in filters if f])) or "attendance"
+    if fmt == "xlsx":
+        if openpyxl is None:
+            return "<h2>❌ XLSX export needs openpyxl installed</h2><a href='/teacher'>Back</a>", 501
+        return Response(_export_xlsx(rows),
+                        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        headers={"Content-Disposition": f'attachment; filename="{name}.xlsx"'})
+    return Response(_export_csv(rows), mimetype="text/csv",
+                    headers={"Content-Disposition": f'attachment; filename="{name}.csv"'})
+
+@app.route("/teacher/summary")
+@login_required
+def summary():
+    filter_class, filter_year, filter_subject, _ = attendance_filters()
+    session_keys = _cached(CODE_FILE, _read_codes)["dates"]
+    students, sessions = [], []
+    if filter_class and filter_year and filter_subject:
+        students = student_summary(filter_class, filter_year, filter_subject)
+        sessions = session_summary(filter_class, filter_year, filter_subject)
+    return render_template(
+        "summary.html",
+        teacher=session["teacher"],
+        classes=load_classes(),
+        years=sorted({k[1] for k in session_keys}),
+        subjects=sorted({k[2] for k in session_keys}),
+        students=students,
+        sessions=sessions,
+        filter_class=filter_class,
+        filter_year=filter_year,
+        filter_subject=filter_subject,
+    )
+
+@app.route("/api/summary")
+@login_required
+def summary_api():
+    filter_class, filter_year, filter_subject, _ = attendance_filters()
+    if not (filter_class and filter_year and filter_subject):
+        return jsonify(error="class, year and subject are required"), 400
+    return jsonify(
+        students=student_summary(filter_class, filter_year, filter_subject),
+        sessions=session_summary(filter_class, filter_year, filter_subject),
+    )
+
 @app.route("/create_code", methods=["GET", "POST"])
 @login_required
 def create_code():
@@ -396,37 +1931,36 @@ def create_code():
         code = generate_code()
         today = datetime.now().strftime("%Y-%m-%d")
 
-        rows = []
-        if os.path.exists(CODE_FILE):
-            with open(CODE_FILE, newline='', encoding="utf-8") as f:
-                rows = list(csv.DictReader(f))
-
-        # remove old entry for same day/class/year/subject
-        rows = [r for r in rows if not (
-            r["date"] == today and r["class"] == class_name and r["year"] == year and r["subject"] == subject
-        )]
-
-        rows.append({
-            "date": today,
-            "class": class_name,
-            "year": year,
-            "subject": subject,
-            "code": code,
-            "lat": lat,
-            "lng": lng
-        })
-
-        # write with location support
-        with open(CODE_FILE, "w", newline='', encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=["date", "class", "year", "subject", "code", "lat", "lng"])
-            writer.writeheader()
-            writer.writerows(rows)
+        with file_lock(CODE_FILE):
+            rows = []
+            if os.path.exists(CODE_FILE):
+                with open(CODE_FILE, newline='', encoding="utf-8") as f:
+                    rows = list(csv.DictReader(f))
+
+            # remove old entry for same day/class/year/subject
+            rows = [r for r in rows if not (
+                r["date"] == today and r["class"] == class_name and r["year"] == year and r["subject"] == subject
+            )]
+
+            rows.append({
+                "date": today,
+                "class": class_name,
+                "year": year,
+                "subject": subject,
+                "code": code,
+                "lat": lat,
+                "lng": lng
+            })
+
+            # write with location support
+            _write_csv_atomic(CODE_FILE, CODE_FIELDS, rows)
+
+        if ROTATE_CODES:
+            # the daily code is not accepted in rotating mode; project the live QR instead
+            return redirect(url_for("qr_code", class_name=class_name, date=today, year=year, subject=subject))
 
         url = f"http://localhost:5000/?class={class_name}&year={year}&subject={subject}&code={code}"
-        qr_img = qrcode.make(url)
-        qr_path = f"static/qrcodes/{class_name}_{year}_{subject}_{today}.png"
-        os.makedirs("static/qrcodes", exist_ok=True)
-        qr_img.save(qr_path)
+        qr_path = qr_image_url(url)
 
         return render_template(
             "create_code_result.html",
@@ -436,6 +1970,7 @@ def create_code():
             today=today,
             code=code,
             qr_path=qr_path,
+            live_url=url_for("live", class_name=class_name, date=today, year=year, subject=subject),
             lat=lat,
             lng=lng
         )
@@ -447,40 +1982,185 @@ def create_code():
 @app.route("/codes")
 @login_required
 def codes():
-    records = []
-    if os.path.exists(CODE_FILE):
-        with open(CODE_FILE, newline='', encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                records.append(row)
+    records = load_codes()
     return render_template("codes.html", codes=records, teacher=session["teacher"])
 
 @app.route("/qr/<class_name>/<date>/<year>/<subject>")
 @login_required
 def qr_code(class_name, date, year, subject):
-    with open(CODE_FILE, newline='', encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row["class"] == class_name and row["date"] == date and row["year"] == year and row["subject"] == subject:
-                code = row["code"]
-                url = f"http://localhost:5000/?class={class_name}&year={year}&subject={subject}&code={code}"
-                qr_path = f"static/qrcodes/{class_name}_{year}_{subject}_{date}.png"
-
-                # regenerate QR
-                qr_img = qrcode.make(url)
-                os.makedirs("static/qrcodes", exist_ok=True)
-                qr_img.save(qr_path)
-
-                return render_template("qr.html",
-                                       class_name=class_name,
-                                       date=date,
-                                       year=year,
-                                       subject=subject,
-                                       code=code,
-                                       url=url,
-                                       qr_path=qr_path)
+    row = get_session(class_name, year, subject, date)
+    if row:
+        rotating = ROTATE_CODES and date == datetime.now().strftime("%Y-%m-%d")
+        if rotating:
+            frame = qr_frame(class_name, date, year, subject)
+            code, url, qr_path = frame["code"], frame["url"], frame["image"]
+        else:
+            code = row["code"]
+            url = f"http://localhost:5000/?class={class_name}&year={year}&subject={subject}&code={code}"
+            qr_path = qr_image_url(url)
+
+        return render_template("qr.html",
+                               class_name=class_name,
+                               date=date,
+                               year=year,
+                               subject=subject,
+                               code=code,
+                               url=url,
+                               qr_path=qr_path,
+                               rotating=rotating,
+                               live_url=url_for("live", class_name=class_name, date=date, year=year, subject=subject),
+                               frame_url=url_for("qr_frame_api", class_name=class_name, date=date,
+                                                 year=year, subject=subject))
     return "<h2>❌ Code not found</h2><a href='/codes'>Back</a>"
 
+def frame_url(class_name, year, subject, window):
+    code = rotating_code(class_name, year, subject, window)
+    return f"http://localhost:5000/?class={class_name}&year={year}&subject={subject}&code={code}"
+
+def qr_frame(class_name, date, year, subject):
+    now = time.time()
+    window = int(now) // ROTATE_SECONDS
+    return {
+        "code": rotating_code(class_name, year, subject, window),
+        "url": frame_url(class_name, year, subject, window),
+        # derived from the window alone, so any worker can render it
+        "image": url_for("qr_frame_image", class_name=class_name, date=date, year=year,
+                         subject=subject, window=window),
+        "expires_in": ROTATE_SECONDS - now % ROTATE_SECONDS,
+    }
+
+@app.route("/qr/<class_name>/<date>/<year>/<subject>/frame")
+@login_required
+def qr_frame_api(class_name, date, year, subject):
+    # polled by qr.html in rotating mode: pure computation, no file access
+    if not ROTATE_CODES:
+        return jsonify(error="code rotation is disabled"), 404
+    return jsonify(qr_frame(class_name, date, year, subject))
+
+@app.route("/qr/<class_name>/<date>/<year>/<subject>/frame/<int:window>.png")
+@login_required
+def qr_frame_image(class_name, date, year, subject, window):
+    current = int(time.time()) // ROTATE_SECONDS
+    # only frames that are still accepted; future codes must not be obtainable early
+    if not ROTATE_CODES or not current - ROTATE_MARK_GRACE <= window <= current:
+        return "QR code not found", 404
+    resp = Response(qr_png(frame_url(class_name, year, subject, window), persist=False), mimetype="image/png")
+    resp.headers["Cache-Control"] = "private, max-age=%d" % ROTATE_SECONDS
+    return resp
+
+@app.route("/qr_image/<digest>.png")
+def qr_image(digest):
+    payload = _qr_payloads.get(digest)
+    if payload:
+        data = qr_png(payload)
+    else:
+        # payload unknown to this process (restart, other worker): serve the disk copy
+        path = os.path.join(QR_DIR, os.path.basename(digest) + ".png")
+        if not os.path.exists(path):
+            return "QR code not found", 404
+        with open(path, "rb") as f:
+            data = f.read()
+    resp = Response(data, mimetype="image/png")
+    # content-addressed, so the browser never needs to ask again
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
+def session_marks(class_name, year, subject, since=0):
+    """Today's marks for a session from position `since` on, with the partition's generation.
+
+    The generation is the inode of today's partition (0 before the first mark), so every
+    worker reports the same value until the file is replaced and positions change meaning.
+    """
+    _sync_attendance()
+    with _index_lock:
+        return _attend_state.get("ino", 0), _session_marks.get((class_name, year, subject), [])[since:]
+
+@app.route("/live/<class_name>/<date>/<year>/<subject>")
+@login_required
+def live(class_name, date, year, subject):
+    """Roster of a session with who is present, kept current over server-sent events."""
+    roster = _cached(STUDENT_FILE, _read_roster)
+    generation, marks = session_marks(class_name, year, subject)
+    streaming = date == _attend_day[0]
+    if not streaming:
+        # a past session cannot change; read it once from its partition
+        marks = [(r["id"], r["name"], r["time"]) for r in iter_attendance(class_name, year, subject, date)]
+        marks.reverse()
+    present = {}
+    for sid, name, marked_at in marks:
+        present.setdefault(sid, (name, marked_at))
+    students = [{"id": sid, "name": roster["students"][sid]["name"], "time": present.get(sid, ("", ""))[1][11:]}
+                for sid in roster["by_class"].get(class_name, [])]
+    on_roster = {s["id"] for s in students}
+    students.extend({"id": sid, "name": name, "time": marked_at[11:]}
+                    for sid, (name, marked_at) in present.items() if sid not in on_roster)
+    return render_template("live.html",
+                           class_name=class_name,
+                           date=date,
+                           year=year,
+                           subject=subject,
+                           students=students,
+                           present=len(present),
+                           streaming=streaming,
+                           events_url=url_for("live_events", class_name=class_name, date=date, year=year,
+                                              subject=subject, since=len(marks), generation=generation),
+                           teacher=session["teacher"])
+
+_live_streams = [0]
+
+@app.route("/live/<class_name>/<date>/<year>/<subject>/events")
+@login_required
+def live_events(class_name, date, year, subject):
+    """Server-sent events with the session's new marks.
+
+    The stream stays open for LIVE_STREAM_SECONDS only on threaded servers;
+    otherwise it sends what is pending and closes, and the browser polls.
+    """
+    # EventSource sends the last id it saw when it reconnects
+    since = request.headers.get("Last-Event-ID") or request.args.get("since", "0")
+    since = int(since) if since.isdigit() else 0
+    generation = request.args.get("generation", type=int)
+    if date != datetime.now().strftime("%Y-%m-%d"):
+        return "", 204  # tells the browser not to reconnect
+
+    threaded = request.environ.get("wsgi.multithread", False)
+
+    def stream(position):
+        with _index_lock:
+            # single-threaded worker or over the limit: send what is pending and let the browser poll
+            polling = not threaded or _live_streams[0] >= LIVE_MAX_STREAMS
+            if not polling:
+                _live_streams[0] += 1
+        try:
+            deadline = time.monotonic() + (0 if polling else LIVE_STREAM_SECONDS)
+            heartbeat = time.monotonic()
+            yield f"retry: {LIVE_RETRY_MS}\n\n"
+            while True:
+                current, marks = session_marks(class_name, year, subject, position)
+                if (generation and current != generation) or _attend_day[0] != date:
+                    # positions refer to a replaced partition (or the day is over): reload the page.
+                    # A page rendered before the partition existed had no marks, so any file fits.
+                    yield "event: reload\ndata: {}\n\n"
+                    return
+                for sid, name, marked_at in marks:
+                    position += 1
+                    yield f"id: {position}\ndata: {json.dumps({'id': sid, 'name': name, 'time': marked_at[11:]})}\n\n"
+                now = time.monotonic()
+                if now >= deadline:
+                    return
+                if now - heartbeat >= 15:
+                    heartbeat = now
+                    yield ": keepalive\n\n"
+                with _marks_changed:
+                    _marks_changed.wait(LIVE_POLL_SECONDS)
+        finally:
+            if not polling:
+                with _index_lock:
+                    _live_streams[0] -= 1
+
+    return Response(stream(since), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/unlock_device", methods=["GET", "POST"])
 @login_required
 def unlock_device():
@@ -503,18 +2183,56 @@ def clear_device_cookie_secure(token):
     if not student_id:
         return render_template("message.html", message="❌ Invalid or expired unlock link.")
     
+    unlock_student(student_id)
     cookie_sid = request.cookies.get("sid")
     resp = make_response(render_template("message.html", message=f"✅ Device unlocked for {student_id}. You can now mark attendance again."))
     resp.delete_cookie("sid")
     resp.delete_cookie("lock_until")
     return resp
 
+# --------- CLI ----------
+@app.cli.command("convert-attendance")
+def convert_attendance():
+    """Write the columnar .bin copy of every closed attendance partition."""
+    _migrate_attendance()
+    today = datetime.now().strftime("%Y-%m-%d")
+    for date in attendance_dates():
+        if date < today:
+            print(f"{columns_path(date)}: {write_partition_columns(date)} rows")
+
+@app.cli.command("compact")
+def compact_command():
+    """Archive past tokens, codes and attendance partitions now."""
+    for name, n in compact().items():
+        print(f"{name}: {n} archived")
+
+@app.cli.command("hash-passwords")
+def hash_passwords():
+    """Replace the plaintext passwords left in TEACHER_FILE with PBKDF2 hashes."""
+    with file_lock(TEACHER_FILE):
+        with open(TEACHER_FILE, newline='', encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        plain = [row for row in rows if not row["password"].startswith(PASSWORD_SCHEME + "$")]
+        for row in plain:
+            row["password"] = hash_password(row["password"])
+        if plain:
+            _write_csv_atomic(TEACHER_FILE, ["username", "password"], rows)
+    print(f"{len(plain)} password(s) hashed")
+
+def warm_caches():
+    """Build the in-memory indexes up front instead of on the first request."""
+    load_students()
+    load_codes()
+    _migrate_attendance()
+    _sync_tokens()
+    _sync_locks()
+    _ensure_aggregates()
+
+warm_caches()
+
 
 if __name__ == "__main__":
-    if not os.path.exists(ATTEND_FILE):
-        with open(ATTEND_FILE, "w", newline='', encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["id","name","class","year","subject","time","code"])
+    os.makedirs(ATTEND_DIR, exist_ok=True)
 
     if not os.path.exists(CODE_FILE):
         with open(CODE_FILE, "w", newline='', encoding="utf-8") as f:
@@ -524,6 +2242,7 @@ if __name__ == "__main__":
     if not os.path.exists(TOKEN_FILE):
         with open(TOKEN_FILE, "w", newline='', encoding="utf-8") as f:
             writer = csv.writer(f)
-            writer.writerow(["token","class","year","subject","date","used","student_id"])
+            writer.writerow(TOKEN_FIELDS)
 
+    # development server; for many concurrent clients serve asgi:application with uvicorn
     app.run(debug=True)
\ No newline at end of file
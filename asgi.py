@@ -0,0 +1,133 @@
+"""ASGI entry point: serve the attendance app from an async server.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 4
+
+Request bodies are read and responses are written on the event loop. The
+Flask app itself (storage, QR encoding, CSV parsing) runs in a bounded thread
+pool only while a request is being handled. Thousands of slow mobile
+connections therefore hold sockets, not threads.
+"""
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from app import app
+
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", "64"))  # requests handled at the same time per worker
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="attendance")
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def _build_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        # PEP 3333: the raw bytes as latin-1, which never fails and round-trips
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+            continue
+        key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def _run_wsgi(environ, send, disconnected):
+    """Run the Flask app in a pool thread, forwarding each response chunk to the loop."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["start"] = {
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers],
+        }
+
+    def send_body(chunk, more_body):
+        if disconnected.is_set():
+            # stops streaming responses (exports, live views) once the client has gone
+            raise ClientDisconnected()
+        if "sent" not in response:
+            response["sent"] = True
+            send(response["start"])
+        send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+    result = app(environ, start_response)
+    try:
+        for chunk in result:
+            if chunk:
+                send_body(chunk, True)
+        send_body(b"", False)
+    except ClientDisconnected:
+        pass
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                _executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    with SpooledTemporaryFile(max_size=65536) as body:
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.write(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        disconnected = threading.Event()
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        watcher = loop.create_task(watch_disconnect())
+        try:
+            await loop.run_in_executor(_executor, _run_wsgi, _build_environ(scope, body),
+                                       send_from_thread, disconnected)
+        finally:
+            watcher.cancel()
@@ -0,0 +1,171 @@
+"""Benchmark the attendance routes against synthetic data.
+
+    python bench.py --students 10000 --days 90 --concurrency 32
+
+Generates students, class codes, tokens and attendance history in a scratch
+directory, then replays a class check-in burst (scan the QR on /, then POST
+/mark) from concurrent clients, followed by teacher dashboard views. Prints
+p50/p99 latency and throughput per route. Nothing in the working tree is touched.
+"""
+import argparse
+import csv
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+CLASS_SIZE = 60
+LAT, LNG = 28.7061, 77.1299
+
+
+def generate(root, students, days, tokens_per_day, attendance_rate):
+    """Write a synthetic dataset into `root` and return the class names."""
+    rng = random.Random(42)
+    classes = [f"CLS{n:04d}" for n in range((students + CLASS_SIZE - 1) // CLASS_SIZE)]
+    today = datetime.now()
+    dates = [(today - timedelta(days=d)).strftime("%Y-%m-%d") for d in range(days, 0, -1)]
+    today = today.strftime("%Y-%m-%d")
+
+    with open(os.path.join(root, "students.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "class", "year"])
+        for i in range(students):
+            writer.writerow([str(100000 + i), f"Student {i}", classes[i // CLASS_SIZE], "1st"])
+
+    with open(os.path.join(root, "teachers.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["username", "password"])
+        writer.writerow(["bench", "bench"])
+
+    with open(os.path.join(root, "class_codes.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["date", "class", "year", "subject", "code", "lat", "lng"])
+        for date in dates + [today]:
+            for c in classes:
+                writer.writerow([date, c, "1st", "SUB", f"{c[-4:]}{date[-2:]}", LAT, LNG])
+
+    with open(os.path.join(root, "tokens.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["token", "class", "year", "subject", "date", "used", "student_id"])
+        for date in dates:
+            for t in range(tokens_per_day):
+                writer.writerow([f"T{date[-5:]}{t:07d}", rng.choice(classes), "1st", "SUB", date, "1", ""])
+
+    os.makedirs(os.path.join(root, "attendance"))
+    for date in dates:
+        with open(os.path.join(root, "attendance", f"{date}.csv"), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "name", "class", "year", "subject", "time", "code"])
+            for i in range(students):
+                if rng.random() < attendance_rate:
+                    c = classes[i // CLASS_SIZE]
+                    writer.writerow([str(100000 + i), f"Student {i}", c, "1st", "SUB",
+                                     f"{date} 09:{i // 600 % 60:02d}:{i % 60:02d}", f"{c[-4:]}{date[-2:]}"])
+    for name in ("lock.csv",):
+        with open(os.path.join(root, name), "w", newline="", encoding="utf-8") as f:
+            f.write("student_id,unlock_time\r\n")
+    return classes, today
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+
+def report(name, samples, wall):
+    if not samples:
+        return
+    print(f"{name:<22} {len(samples):>7} {percentile(samples, 50) * 1000:>9.2f} "
+          f"{percentile(samples, 99) * 1000:>9.2f} {len(samples) / wall:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=1000, help="roster size")
+    parser.add_argument("--days", type=int, default=30, help="days of attendance/token history")
+    parser.add_argument("--tokens-per-day", type=int, default=None, help="historic tokens per day (default: roster size)")
+    parser.add_argument("--attendance-rate", type=float, default=0.8, help="share of students present per historic day")
+    parser.add_argument("--burst", type=int, default=None, help="students checking in during the burst (default: min(roster, 2000))")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--teacher-views", type=int, default=50, help="dashboard requests after the burst")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="attendance-bench-")
+    started = time.perf_counter()
+    classes, today = generate(root, args.students, args.days,
+                              args.students if args.tokens_per_day is None else args.tokens_per_day,
+                              args.attendance_rate)
+    print(f"generated {args.students} students, {args.days} days of history in {root} "
+          f"({time.perf_counter() - started:.1f}s)")
+
+    # app.py resolves its data files relative to the working directory
+    os.chdir(root)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    started = time.perf_counter()
+    import app as attendance
+    print(f"import + cache warm-up: {time.perf_counter() - started:.2f}s")
+
+    teacher = attendance.app.test_client()
+    teacher.post("/login", data={"username": "bench", "password": "bench"})
+
+    timings = {}
+
+    def timed(route, call):
+        t0 = time.perf_counter()
+        response = call()
+        timings.setdefault(route, []).append(time.perf_counter() - t0)
+        return response
+
+    def check_in(i):
+        client = attendance.app.test_client()
+        sid = str(100000 + i)
+        c = classes[i // CLASS_SIZE]
+        code = f"{c[-4:]}{today[-2:]}"
+        page = timed("GET /", lambda: client.get(f"/?class={c}&year=1st&subject=SUB&code={code}"))
+        token = re.search(r'name="token" value="([^"]*)"', page.get_data(as_text=True)).group(1)
+        result = timed("POST /mark", lambda: client.post("/mark", data={
+            "student_id": sid, "class_code": code, "class_name": c, "year": "1st", "subject": "SUB",
+            "token": token, "student_lat": LAT, "student_lng": LNG,
+        }))
+        return "✅" in result.get_data(as_text=True)
+
+    burst = min(args.students, 2000) if args.burst is None else min(args.burst, args.students)
+    order = random.Random(7).sample(range(args.students), burst)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        marked = sum(pool.map(check_in, order))
+    burst_wall = time.perf_counter() - started
+
+    views = [
+        ("GET /teacher", "/teacher"),
+        ("GET /teacher?date", f"/teacher?date={today}"),
+        ("GET /teacher?class", f"/teacher?class={classes[0]}&page=2"),
+        ("GET /api/summary", f"/api/summary?class={classes[0]}&year=1st&subject=SUB"),
+    ]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(lambda n: timed(views[n % len(views)][0],
+                                      lambda: teacher.get(views[n % len(views)][1]).get_data()),
+                      range(args.teacher_views)))
+    teacher_wall = time.perf_counter() - started
+
+    print(f"\ncheck-in burst: {marked}/{burst} marked, concurrency {args.concurrency}, {burst_wall:.2f}s")
+    print(f"{'route':<22} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>10}")
+    for route in ("GET /", "POST /mark"):
+        report(route, timings.get(route, []), burst_wall)
+    for route, _ in views:
+        report(route, timings.get(route, []), teacher_wall)
+
+    if not args.keep:
+        os.chdir(os.path.dirname(root))
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import csv
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STUDENTS = 40
+SESSION = ("BCA", "1st", "WT")
+
+
+@pytest.fixture
+def att(tmp_path, monkeypatch):
+    """app.py imported with an empty data directory as the working directory."""
+    monkeypatch.chdir(tmp_path)
+    with open("students.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "class", "year"])
+        for i in range(STUDENTS):
+            writer.writerow([str(100 + i), f"Student {i}", SESSION[0], SESSION[1]])
+    os.makedirs("attendance")
+    import app
+    return importlib.reload(app)
@@ -0,0 +1,130 @@
+"""Compaction: archived rows stay readable, reruns are harmless and appends are never lost."""
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import SESSION
+
+
+def day(days_ago):
+    return (datetime.now() - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+
+
+@pytest.fixture
+def data(att):
+    """Two attendance days past retention and one within it, plus past and current codes and tokens."""
+    att._compacted[0] = day(0)  # no background compaction behind the tests' backs
+    old, older, recent = day(att.ATTEND_RETAIN_DAYS + 10), day(att.ATTEND_RETAIN_DAYS + 11), day(3)
+    for date, ids in ((older, range(100, 105)), (old, range(100, 108)), (recent, range(100, 103))):
+        att._append_csv(att.attendance_path(date), att.ATTEND_FIELDS, [
+            {"id": str(i), "name": f"Student {i - 100}", "class": SESSION[0], "year": SESSION[1],
+             "subject": SESSION[2], "time": f"{date} 09:{i - 100:02d}:00", "code": f"C{date[-2:]}"}
+            for i in ids])
+    att._append_csv(att.CODE_FILE, att.CODE_FIELDS, [
+        {"date": date, "class": SESSION[0], "year": SESSION[1], "subject": SESSION[2], "code": f"C{date[-2:]}"}
+        for date in (older, old, recent, day(0))])
+    att._append_csv(att.TOKEN_FILE, att.TOKEN_FIELDS, [
+        {"token": f"OLD{n}", "class": SESSION[0], "year": SESSION[1], "subject": SESSION[2],
+         "date": day(n + 1), "used": str(n % 2), "student_id": ""} for n in range(6)])
+    fresh, used = att.generate_token(), att.generate_token()
+    for token in (fresh, used):
+        att.save_token(token, *SESSION)
+    assert att.commit_attendance([{"id": "100", "name": "Student 0", "class": SESSION[0], "year": SESSION[1],
+                                   "subject": SESSION[2], "time": f"{day(0)} 09:00:00", "code": f"C{day(0)[-2:]}",
+                                   "token": used}]) == ["ok"]
+    client = att.app.test_client()
+    with client.session_transaction() as s:
+        s["teacher"] = "admina"
+    return {"att": att, "client": client, "dates": (older, old, recent, day(0)), "fresh": fresh, "used": used}
+
+
+def snapshot(data):
+    """Everything a teacher can read, per date and overall."""
+    att, client = data["att"], data["client"]
+    views = {}
+    for date in data["dates"]:
+        views[date] = (att.count_attendance(filter_date=date), list(att.iter_attendance(filter_date=date)),
+                       client.get(f"/teacher?date={date}").get_data(as_text=True))
+    views["all"] = (att.count_attendance(), list(att.iter_attendance()), client.get("/teacher").get_data(as_text=True))
+    views["codes"] = (sorted(tuple(sorted(r.items())) for r in att.load_codes()),
+                      client.get("/codes").get_data(as_text=True))
+    return views
+
+
+def archive_contents(att):
+    return {n: sorted(map(str, att._read_gzip_csv(os.path.join(att.ARCHIVE_DIR, n))))
+            for n in sorted(os.listdir(att.ARCHIVE_DIR)) if n.endswith(".csv.gz")}
+
+
+def test_archived_rows_read_back(data):
+    att = data["att"]
+    older, old, recent, today = data["dates"]
+    before = snapshot(data)
+    assert before[old][0] == 8 and "8 record(s)" in before[old][2]
+
+    assert att.compact() == {"tokens": 6, "codes": 3, "attendance": 2}
+
+    assert not os.path.exists(att.attendance_path(old)) and not os.path.exists(att.attendance_path(older))
+    assert os.path.exists(att.attendance_path(recent))
+    assert {r["date"] for r in att._read_complete_rows(att.CODE_FILE)} == {today}
+    assert {r["date"] for r in att._read_complete_rows(att.TOKEN_FILE)} == {today}
+    assert snapshot(data) == before
+    assert att.check_token(data["fresh"], *SESSION) == data["fresh"]
+    assert att.check_token(data["used"], *SESSION) is None
+    assert att.attendance_exists("103", *SESSION, old, f"C{old[-2:]}")
+
+
+def test_compaction_is_idempotent(data):
+    att = data["att"]
+    before = snapshot(data)
+    att.compact()
+    archived = archive_contents(att)
+    assert att.compact() == {"tokens": 0, "codes": 0, "attendance": 0}
+    assert archive_contents(att) == archived
+
+    # a crash after the segments were written but before the hot files were rewritten
+    # leaves the rows in both places; the rerun must not archive them twice
+    codes = [r for r in att._read_gzip_csv(att.archive_path("class_codes", data["dates"][1][:7]))]
+    att._append_csv(att.CODE_FILE, att.CODE_FIELDS, codes)
+    assert att.compact()["codes"] == len(codes)
+    assert archive_contents(att) == archived
+    assert snapshot(data) == before
+
+
+def test_compaction_keeps_concurrent_appends(data):
+    att = data["att"]
+    stop = threading.Event()
+    saved = []
+
+    def issue():
+        while not stop.is_set():
+            token = att.generate_token()
+            att.save_token(token, *SESSION)
+            saved.append(token)
+
+    def code_rows(n):
+        return [{"date": day(1), "class": f"C{n}-{k}", "year": SESSION[1], "subject": SESSION[2], "code": "X"}
+                for k in range(5)]
+
+    writers = [threading.Thread(target=issue) for _ in range(4)]
+    for writer in writers:
+        writer.start()
+    try:
+        for n in range(20):
+            # past rows arrive between compactions, today's rows keep arriving during them
+            with att.file_lock(att.CODE_FILE):
+                att._append_csv(att.CODE_FILE, att.CODE_FIELDS, code_rows(n))
+            att.compact()
+    finally:
+        stop.set()
+        for writer in writers:
+            writer.join()
+
+    hot = [r["token"] for r in att._read_complete_rows(att.TOKEN_FILE)]
+    assert sorted(hot) == sorted(saved + [data["fresh"], data["used"], data["used"]])
+    assert all(att.check_token(token, *SESSION) == token for token in saved)
+    archived = [(r["class"], r["date"]) for r in att._read_archived_codes()]
+    assert len(archived) == len(set(archived))
+    assert {f"C{n}-{k}" for n in range(20) for k in range(5)} <= {c for c, _ in archived}
@@ -0,0 +1,64 @@
+"""The ASGI adapter in asgi.py, driven with hand-built scopes."""
+import asyncio
+import importlib
+
+import pytest
+from werkzeug.wrappers import Request
+
+
+@pytest.fixture
+def asgi(att):
+    import asgi
+    return importlib.reload(asgi)
+
+
+def call(asgi, method, path, query=b"", body=b"", headers=()):
+    """Run one request through asgi.application; returns (status, headers, body)."""
+    scope = {"type": "http", "method": method, "path": path, "query_string": query,
+             "http_version": "1.1", "headers": [(k.encode("latin1"), v.encode("latin1")) for k, v in headers],
+             "client": ("10.0.0.1", 50000), "server": ("testserver", 80)}
+    sent = []
+    incoming = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if incoming:
+            return incoming.pop(0)
+        await asyncio.sleep(3600)  # the client stays connected
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.application(scope, receive, send))
+    start = next(m for m in sent if m["type"] == "http.response.start")
+    chunks = [m for m in sent if m["type"] == "http.response.body"]
+    assert chunks and not chunks[-1].get("more_body")
+    return start["status"], dict(start["headers"]), b"".join(m["body"] for m in chunks)
+
+
+def test_get(asgi):
+    status, headers, body = call(asgi, "GET", "/login")
+    assert status == 200
+    assert headers[b"content-type"].startswith(b"text/html")
+    assert b"<form" in body
+
+
+def test_non_ascii_query_string(asgi, monkeypatch):
+    # raw UTF-8 bytes in the query string reach the app intact
+    def echo(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain; charset=utf-8")])
+        return [Request(environ).args["class"].encode("utf-8")]
+
+    assert call(asgi, "GET", "/", query="class=é&year=1st".encode("utf-8"))[0] == 200
+    monkeypatch.setattr(asgi, "app", echo)
+    assert call(asgi, "GET", "/", query="class=é".encode("utf-8")) == (
+        200, {b"content-type": b"text/plain; charset=utf-8"}, "é".encode("utf-8"))
+
+
+def test_post_form_body(asgi):
+    form = b"username=nobody&password=wrong"
+    status, _, body = call(asgi, "POST", "/login", body=form,
+                           headers=[("content-type", "application/x-www-form-urlencoded"),
+                                    ("content-length", str(len(form)))])
+    assert status == 200
+    assert "Invalid Credentials".encode() in body
+
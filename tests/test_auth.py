@@ -0,0 +1,91 @@
+"""Teacher password hashing and /login rate limiting."""
+import csv
+
+import pytest
+
+
+@pytest.fixture
+def auth(att):
+    att.PASSWORD_ITERATIONS = 1000  # keeps the tests fast; each hash records its own count
+    with open(att.TEACHER_FILE, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["username", "password"])
+        writer.writerow(["hashed", att.hash_password("secret")])
+        writer.writerow(["plain", "letmein"])
+    return att
+
+
+def login(client, username, password, ip="10.0.0.1"):
+    return client.post("/login", data={"username": username, "password": password},
+                       environ_base={"REMOTE_ADDR": ip})
+
+
+def test_hash_password(auth):
+    stored = auth.hash_password("secret")
+    scheme, iterations, _, _ = stored.split("$")
+    assert (scheme, iterations) == (auth.PASSWORD_SCHEME, "1000")
+    assert stored != auth.hash_password("secret")  # salted
+    assert auth.verify_password("secret", stored)
+    assert not auth.verify_password("Secret", stored)
+
+
+def test_hash_records_its_iterations(auth):
+    stored = auth.hash_password("secret", iterations=500)
+    auth.PASSWORD_ITERATIONS = 2000
+    assert auth.verify_password("secret", stored)
+
+
+def test_plaintext_fallback(auth):
+    assert auth.verify_password("letmein", "letmein")
+    assert not auth.verify_password("letmein", "letmeout")
+    assert not auth.verify_password("", "letmein")
+
+
+def test_malformed_hash_is_rejected(auth):
+    assert not auth.verify_password("secret", auth.PASSWORD_SCHEME + "$x$y")
+    assert not auth.verify_password("secret", auth.PASSWORD_SCHEME + "$1000$!!$!!")
+
+
+def test_check_teacher(auth):
+    assert auth.check_teacher("hashed", "secret")
+    assert auth.check_teacher("plain", "letmein")
+    assert not auth.check_teacher("hashed", "letmein")
+    assert not auth.check_teacher("nobody", "secret")
+
+
+def test_rate_limit(auth, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(auth.time, "monotonic", lambda: clock[0])
+    assert [auth.rate_limit("k", 60, 3) for _ in range(3)] == [0, 0, 0]
+    assert auth.rate_limit("k", 60, 3) == pytest.approx(1.0)
+    assert auth.rate_limit("other", 60, 3) == 0  # buckets are per key
+    clock[0] += 2  # refills at per_minute / 60 tokens a second
+    assert [auth.rate_limit("k", 60, 3) for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+    auth.rate_limit_refund("k", 3)
+    assert auth.rate_limit("k", 60, 3) == 0
+
+
+def test_successful_logins_are_not_throttled(auth):
+    # a whole staff room signing in from one NAT address
+    client = auth.app.test_client()
+    for _ in range(3 * max(auth.LOGIN_BURST, auth.LOGIN_IP_BURST)):
+        assert login(client, "hashed", "secret").status_code == 302
+
+
+def test_failed_logins_are_throttled_per_user(auth):
+    client = auth.app.test_client()
+    for _ in range(auth.LOGIN_BURST):
+        assert login(client, "hashed", "wrong").status_code == 200
+    resp = login(client, "hashed", "secret")
+    assert resp.status_code == 429
+    assert int(resp.headers["Retry-After"]) > 0
+    # other teachers behind the same address still get in
+    assert login(client, "plain", "letmein").status_code == 302
+
+
+def test_failed_logins_are_throttled_per_ip(auth):
+    client = auth.app.test_client()
+    for n in range(auth.LOGIN_IP_BURST):
+        assert login(client, f"guess{n}", "wrong").status_code == 200
+    assert login(client, "plain", "letmein").status_code == 429
+    assert login(client, "plain", "letmein", ip="10.0.0.2").status_code == 302
@@ -0,0 +1,220 @@
+"""Concurrency and atomicity of the attendance commit path.
+
+Each test imports app.py afresh inside an empty data directory, then drives
+commit_attendance (or the group-commit writer behind submit_attendance) from
+many threads or worker processes and checks the files: one row per student,
+every token consumed at most once, and every attendance row backed by exactly
+one used-token row.
+"""
+import csv
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytest
+
+from conftest import SESSION, STUDENTS
+
+
+def now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def new_token(att):
+    token = att.generate_token()
+    att.save_token(token, *SESSION)
+    return token
+
+
+def make_entry(sid, token, time):
+    return {"id": sid, "name": f"Student {sid}", "class": SESSION[0], "year": SESSION[1],
+            "subject": SESSION[2], "time": time, "code": "CODE", "token": token}
+
+
+def attempts(tokens, time, rounds=3):
+    # every student tries several tokens, and every token is tried by several students
+    return [make_entry(str(100 + i), tokens[(i + k) % len(tokens)], time)
+            for k in range(rounds) for i in range(STUDENTS)]
+
+
+def read_csv(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def check_files(att, date):
+    """Assert the on-disk invariants and return the attendance rows."""
+    rows = read_csv(att.attendance_path(date))
+    ids = [r["id"] for r in rows]
+    assert len(ids) == len(set(ids)), "a student was marked twice"
+    used = [r for r in read_csv(att.TOKEN_FILE) if r["used"] == "1"]
+    tokens = [r["token"] for r in used]
+    assert len(tokens) == len(set(tokens)), "a token was consumed twice"
+    assert sorted(r["student_id"] for r in used) == sorted(ids), "attendance and token rows disagree"
+    return rows
+
+
+def test_concurrent_threads_commit_each_student_and_token_once(att):
+    time = now()
+    tokens = [new_token(att) for _ in range(STUDENTS)]
+
+    with ThreadPoolExecutor(16) as pool:
+        statuses = [s for result in pool.map(lambda e: att.commit_attendance([e]), attempts(tokens, time))
+                    for s in result]
+
+    rows = check_files(att, time[:10])
+    assert statuses.count("ok") == len(rows) > 0
+    assert set(statuses) <= {"ok", "duplicate", "used_token"}
+
+
+def _commit_in_process(att, entries, results):
+    results.put([att.commit_attendance([e])[0] for e in entries])
+
+
+def test_concurrent_processes_commit_each_student_and_token_once(att):
+    # separate workers share nothing in memory; only file_lock keeps them apart
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("needs the fork start method")
+    ctx = multiprocessing.get_context("fork")
+    time = now()
+    tokens = [new_token(att) for _ in range(STUDENTS)]
+    entries = attempts(tokens, time)
+
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_commit_in_process, args=(att, entries[n::4], results)) for n in range(4)]
+    for worker in workers:
+        worker.start()
+    statuses = [s for _ in workers for s in results.get(timeout=60)]
+    for worker in workers:
+        worker.join(10)
+        assert worker.exitcode == 0
+
+    rows = check_files(att, time[:10])
+    assert statuses.count("ok") == len(rows) > 0
+
+
+def test_failed_token_append_rolls_back_attendance(att):
+    time = now()
+    token = new_token(att)
+    append = att._append_csv
+
+    def failing_append(target, *args, **kwargs):
+        if target == att.TOKEN_FILE:
+            raise OSError("disk full")
+        return append(target, *args, **kwargs)
+
+    att._append_csv = failing_append
+    try:
+        with pytest.raises(OSError):
+            att.commit_attendance([make_entry("100", token, time)])
+    finally:
+        att._append_csv = append
+
+    assert read_csv(att.attendance_path(time[:10])) == []
+    assert not att.attendance_exists("100", *SESSION, time[:10], "CODE")
+    assert att.check_token(token, *SESSION) == token
+    # the same submission goes through once the store works again
+    assert att.commit_attendance([make_entry("100", token, time)]) == ["ok"]
+    check_files(att, time[:10])
+
+
+def test_used_token_is_rejected(att):
+    time = now()
+    token = new_token(att)
+    assert att.commit_attendance([make_entry("100", token, time)]) == ["ok"]
+    assert att.check_token(token, *SESSION) is None
+    assert att.commit_attendance([make_entry("101", token, time)]) == ["used_token"]
+
+
+def test_duplicates_within_one_batch(att):
+    time = now()
+    token, other = new_token(att), new_token(att)
+    assert att.commit_attendance([make_entry("100", token, time), make_entry("100", other, time),
+                                  make_entry("101", token, time)]) == ["ok", "duplicate", "used_token"]
+    check_files(att, time[:10])
+    assert att.check_token(other, *SESSION) == other
+
+
+def test_group_commit_from_many_requests(att):
+    assert att.GROUP_COMMIT
+    time = now()
+    tokens = [new_token(att) for _ in range(STUDENTS)]
+
+    with ThreadPoolExecutor(32) as pool:
+        statuses = [s for result in pool.map(lambda e: att.submit_attendance([e]), attempts(tokens, time))
+                    for s in result]
+
+    rows = check_files(att, time[:10])
+    assert statuses.count("ok") == len(rows) > 0
+
+
+def test_group_commit_returns_each_request_its_own_statuses(att):
+    time = now()
+    token, other = new_token(att), new_token(att)
+    assert att.submit_attendance([make_entry("100", token, time), make_entry("100", other, time),
+                                  make_entry("101", token, time)]) == ["ok", "duplicate", "used_token"]
+    check_files(att, time[:10])
+
+
+def test_group_commit_failure_reaches_every_request(att):
+    time = now()
+    tokens = [new_token(att) for _ in range(8)]
+    append = att._append_csv
+
+    def failing_append(target, *args, **kwargs):
+        if target == att.TOKEN_FILE:
+            raise OSError("disk full")
+        return append(target, *args, **kwargs)
+
+    def submit(n):
+        try:
+            return att.submit_attendance([make_entry(str(100 + n), tokens[n], time)])
+        except OSError as exc:
+            return exc
+
+    att._append_csv = failing_append
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(submit, range(8)))
+    finally:
+        att._append_csv = append
+
+    assert all(isinstance(r, OSError) for r in results)
+    assert read_csv(att.attendance_path(time[:10])) == []
+    assert all(att.check_token(t, *SESSION) == t for t in tokens)
+
+
+def test_group_commit_timeout_withdraws_queued_rows(att):
+    # a slow commit holds the writer; the request queued behind it times out
+    time = now()
+    first, second = new_token(att), new_token(att)
+    commit = att.commit_attendance
+    started, release = threading.Event(), threading.Event()
+
+    def slow_commit(entries):
+        started.set()
+        release.wait(10)
+        return commit(entries)
+
+    att.commit_attendance = slow_commit
+    att.GROUP_COMMIT_TIMEOUT = 0
+    try:
+        with ThreadPoolExecutor(1) as pool:
+            taken = pool.submit(att.submit_attendance, [make_entry("100", first, time)])
+            assert started.wait(10)
+            with pytest.raises(RuntimeError):
+                att.submit_attendance([make_entry("101", second, time)])
+            release.set()
+            # the request the writer had taken waits past the timeout for its result
+            assert taken.result(10) == ["ok"]
+    finally:
+        att.commit_attendance = commit
+        release.set()
+
+    # the withdrawn request is never written, so the student can simply retry
+    assert [r["id"] for r in check_files(att, time[:10])] == ["100"]
+    assert att.submit_attendance([make_entry("101", second, time)]) == ["ok"]
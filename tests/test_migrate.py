@@ -0,0 +1,49 @@
+"""Splitting a legacy attendance.csv into day partitions."""
+import csv
+import os
+
+from conftest import SESSION
+
+
+def rows_for(date, ids):
+    return [{"id": str(i), "name": f"Student {i - 100}", "class": SESSION[0], "year": SESSION[1],
+             "subject": SESSION[2], "time": f"{date} 09:{i - 100:02d}:00", "code": "CODE"} for i in ids]
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def write_legacy(att, rows):
+    with open(att.ATTEND_FILE, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=att.ATTEND_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def test_legacy_file_is_split_by_day(att):
+    write_legacy(att, rows_for("2025-01-06", range(100, 104)) + rows_for("2025-01-07", range(100, 102)))
+    att._migrate_attendance()
+    assert read_csv(att.attendance_path("2025-01-06")) == rows_for("2025-01-06", range(100, 104))
+    assert read_csv(att.attendance_path("2025-01-07")) == rows_for("2025-01-07", range(100, 102))
+    assert not os.path.exists(att.ATTEND_FILE)
+    assert os.path.exists(att.ATTEND_FILE + ".migrated")
+
+
+def test_rerun_after_crash_does_not_duplicate_rows(att):
+    legacy = rows_for("2025-01-06", range(100, 104)) + rows_for("2025-01-07", range(100, 102))
+    write_legacy(att, legacy)
+    # a crash after the first day was written but before attendance.csv was renamed
+    att._write_csv_atomic(att.attendance_path("2025-01-06"), att.ATTEND_FIELDS, rows_for("2025-01-06", range(100, 104)))
+    att._migrate_attendance()
+    assert read_csv(att.attendance_path("2025-01-06")) == rows_for("2025-01-06", range(100, 104))
+    assert read_csv(att.attendance_path("2025-01-07")) == rows_for("2025-01-07", range(100, 102))
+
+
+def test_rows_already_in_a_partition_are_kept(att):
+    write_legacy(att, rows_for("2025-01-06", range(100, 103)))
+    att._append_csv(att.attendance_path("2025-01-06"), att.ATTEND_FIELDS, rows_for("2025-01-06", range(102, 105)))
+    att._migrate_attendance()
+    assert read_csv(att.attendance_path("2025-01-06")) == (rows_for("2025-01-06", range(102, 105))
+                                                           + rows_for("2025-01-06", range(100, 102)))